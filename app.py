@@ -1,14 +1,29 @@
 # app.py
 
 # Importações necessárias para a aplicação Flask
-from flask import Flask, render_template, request, jsonify, session, send_file, redirect, url_for, flash
+from flask import Flask, render_template, request, jsonify, session, redirect, url_for, flash, g, Response, has_request_context
 import pyodbc # Para conectar ao SQL Server (banco de dados principal)
+# Habilita o pool de conexões do próprio gerenciador ODBC. Precisa ser definido antes da primeira conexão.
+pyodbc.pooling = True
 import sqlite3 # Para conectar ao SQLite (banco de dados da coleta local)
-from io import StringIO, BytesIO # Para manipulação de arquivos em memória (geração do TXT)
-from datetime import datetime, timedelta # Para manipular datas e tempos (formatação, tempo de sessão)
+from datetime import date, datetime, timedelta # Para manipular datas e tempos (formatação, tempo de sessão)
 import json # Para ler/escrever arquivos JSON (configurações do DB)
 import os # Para interagir com o sistema de arquivos (verificar existência de arquivos)
-import threading # Para garantir acesso seguro ao arquivo de configuração do DB
+import threading # Para nomear o arquivo temporário de cada thread ao salvar a configuração do DB
+import queue # Para o pool de conexões reutilizáveis com o SQL Server
+from contextlib import contextmanager # Para emprestar conexões do pool com 'with'
+import time # Para controlar a validade do cache local de produtos
+import zlib # Para compactar (gzip) o arquivo de importação durante a transmissão
+from flask.json.provider import DefaultJSONProvider # Base para o serializador JSON com orjson
+from flask.sessions import SecureCookieSession, SecureCookieSessionInterface # Base da sessão sem cookie nas rotas JSON
+try:
+    import orjson # Serialização JSON nativa (opcional); sem ela, o json padrão do Flask é usado
+except ImportError:
+    orjson = None
+try:
+    from flask_compress import Compress # Compressão gzip/deflate das respostas (opcional)
+except ImportError:
+    Compress = None
 
 # Importa a classe de configuração do arquivo config.py
 from config import Config
@@ -18,33 +33,419 @@ app = Flask(__name__)
 # Carrega as configurações da classe Config (SECRET_KEY, DB_CONFIG_PATH)
 app.config.from_object(Config)
 
+
+class OrjsonProvider(DefaultJSONProvider):
+    """
+    Provedor JSON do Flask que usa o orjson para serializar as respostas de jsonify()
+    e interpretar o corpo das requisições. Tipos que o orjson não conhece (ex.: Decimal
+    vindo do SQL Server) passam pelo mesmo conversor padrão do Flask.
+    """
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj, default=self.default), mimetype=self.mimetype)
+
+if orjson is not None:
+    app.json = OrjsonProvider(app)
+# JSON sem indentação mesmo com debug=True (o provedor padrão indenta em modo debug).
+app.json.compact = True
+
+# Compressão das respostas JSON (ex.: produtos com muitos lotes) acima de COMPRESS_MIN_SIZE bytes,
+# se o flask-compress estiver instalado. O arquivo de importação (text/plain, em streaming) fica de fora.
+if Compress is not None:
+    app.config['COMPRESS_MIMETYPES'] = ['application/json']
+    app.config['COMPRESS_MIN_SIZE'] = 500
+    app.config['COMPRESS_LEVEL'] = 4 # Quase a mesma taxa do nível 6 (padrão) em JSON repetitivo, com menos CPU
+    Compress(app)
+
 # --- Configuração de Sessão Padrão do Flask (baseada em cookie) ---
 # Esta sessão é usada principalmente para armazenar mensagens flash temporárias.
 # A lista de coleta de produtos agora é armazenada no SQLite, não na sessão.
 app.config["SESSION_PERMANENT"] = False # A sessão expira ao fechar o navegador
 app.config["PERMANENT_SESSION_LIFETIME"] = timedelta(minutes=30) # Tempo de vida para sessões permanentes (se SESSION_PERMANENT fosse True)
 
+# Rotas JSON chamadas a cada bipagem/edição pelo frontend. Elas não exibem mensagens flash,
+# então não precisam ler (verificar a assinatura HMAC) nem regravar o cookie de sessão.
+API_PATHS = frozenset({
+    '/search_product',
+    '/search_products_batch',
+    '/invalidate_product_cache',
+    '/add_to_selected_lot',
+    '/add_to_selected_lot_bulk',
+    '/add_to_last_counted_lot',
+    '/get_counted_products',
+    '/update_counted_product',
+    '/delete_counted_product',
+    '/delete_counted_products_bulk',
+    '/clear_counted_products',
+    '/health/db',
+})
+
+class ApiAwareSessionInterface(SecureCookieSessionInterface):
+    """
+    Sessão em cookie padrão do Flask, exceto nas rotas de API_PATHS: nelas a requisição recebe
+    uma sessão vazia em memória, sem decodificar o cookie, e nada é gravado na resposta.
+    Mensagens flash pendentes (ex.: de um redirect para /settings) continuam no cookie para a
+    próxima página; um flash eventualmente emitido numa rota JSON é descartado, pois não seria exibido.
+    """
+    def open_session(self, app, request):
+        if request.path in API_PATHS:
+            return SecureCookieSession()
+        return super().open_session(app, request)
+
+    def save_session(self, app, session, response):
+        if request.path in API_PATHS:
+            return # Cookie da sessão fica como está no navegador
+        super().save_session(app, session, response)
+
+app.session_interface = ApiAwareSessionInterface()
+
 # Caminho para o arquivo de configuração do banco de dados SQL Server (definido em config.py)
 DB_CONFIG_FILE = app.config['DB_CONFIG_PATH']
-# Lock para garantir que apenas uma thread acesse o arquivo de configuração do DB por vez.
-# Isso previne condições de corrida ao ler/escrever o db_config.json.
-db_config_lock = threading.Lock()
+# Cache em memória do db_config.json: o arquivo só é relido e reinterpretado quando sua data
+# de modificação muda, em vez de a cada busca de produto. save_db_config() invalida o cache.
+# Guarda a tupla (mtime, config) numa única entrada para que seja lida e trocada de uma só vez:
+# a atribuição é atômica, então leitores e escritores não precisam de lock.
+_db_cfg_cache = {'entry': (0, None)}
+
+# Pool de conexões com o SQL Server. O handshake TDS do pyodbc.connect() custa dezenas
+# de milissegundos, então as conexões são devolvidas a esta fila ao final de cada rota
+# e reaproveitadas pelas próximas requisições em vez de serem fechadas.
+SQLSERVER_POOL_SIZE = 8
+sqlserver_pool = queue.Queue(maxsize=SQLSERVER_POOL_SIZE)
+# Timeout (em segundos) do "SELECT 1" que verifica se uma conexão do pool ainda está viva.
+SQLSERVER_PING_TIMEOUT = 1
+# Espera máxima (em segundos) do keepalive entre tentativas enquanto o SQL Server não está configurado
+# ou não aceita conexões: o intervalo dobra a cada falha até este limite (ver sqlserver_keepalive_loop).
+SQLSERVER_KEEPALIVE_MAX_BACKOFF = 30 * 60
+# String de conexão montada a partir da última configuração carregada. Só é reconstruída
+# (e o pool esvaziado) quando load_db_config() devolve uma configuração diferente.
+_sqlserver_conn_str_cache = {'config': None, 'conn_str': None}
+# Cursores reaproveitados de cada conexão do pool: {conexão: {nome da consulta: cursor}}
+# (ver get_sqlserver_cursor). Cada conexão é usada por uma requisição de cada vez.
+_sqlserver_cursors = {}
+# Quantidade de linhas lidas por vez (cursor.arraysize / fetchmany) nas consultas que devolvem
+# vários lotes, para que produtos com muitos lotes sejam lidos em blocos e não linha a linha.
+SQLSERVER_FETCH_ROWS = 256
+# Tipo fixo do parâmetro do código de barras na busca de produto: VARCHAR(50), o mesmo a cada
+# chamada. Sem isso o pyodbc envia NVARCHAR com o tamanho do texto recebido, e o SQL Server
+# guarda um plano por tamanho, além de converter p.Cod_EAN para comparar com um Unicode.
+# Códigos mais longos que SEARCH_BARCODE_MAX_LEN nem chegam ao SQL Server (ver search_product):
+# o driver recusaria o parâmetro com "String data, right truncation" (22001).
+SEARCH_BARCODE_MAX_LEN = 50
+SEARCH_BARCODE_INPUT_SIZES = [(pyodbc.SQL_VARCHAR, SEARCH_BARCODE_MAX_LEN, 0)]
+# Máximo de códigos por chamada de /search_products_batch (cada código é um parâmetro do IN;
+# o SQL Server aceita até 2100 parâmetros por comando).
+SEARCH_BATCH_MAX = 100
 
 # --- Configuração do Banco de Dados SQLite para a Coleta ---
 # O arquivo SQLite será criado na mesma pasta do app.py.
 # Este banco de dados armazenará os produtos coletados de forma centralizada e persistente.
 COLLECTION_DB_PATH = 'coleta_estoque.db'
+# Versão do esquema da coleta, gravada em PRAGMA user_version no arquivo.
+# Deve ser incrementada sempre que init_collection_db() ganhar uma tabela, índice ou migração nova.
+COLLECTION_SCHEMA_VERSION = 4
+# As gravações da coleta devolvem a linha alterada com UPDATE/INSERT/DELETE ... RETURNING,
+# disponível a partir do SQLite 3.35. Falha já na inicialização, com uma mensagem clara,
+# em vez de cada rota de escrita falhar com erro de sintaxe.
+if sqlite3.sqlite_version_info < (3, 35, 0):
+    raise RuntimeError(f"SQLite {sqlite3.sqlite_version} não suporta RETURNING; é necessária a versão 3.35 ou superior "
+                       "(atualize o Python ou a biblioteca SQLite do sistema).")
+
+# Conexões SQLite da coleta reaproveitadas entre requisições (ver get_coll_db / close_coll_db),
+# para não pagar a abertura do arquivo e os PRAGMAs por conexão a cada requisição.
+COLLECTION_POOL_SIZE = 8
+collection_pool = queue.Queue(maxsize=COLLECTION_POOL_SIZE)
+
+# Validação de saldo de um lote em um único comando: a soma do saldo e a comparação com a
+# quantidade pedida são feitas pelo próprio SQL Server (ver validate_lot_saldo).
+# Sem GROUP BY, o SUM devolve sempre uma linha (NULL se o lote não existir, tratado pelo ISNULL),
+# e o plano não precisa de um operador de agregação por grupo.
+# Índice recomendado no SQL Server (criado pelo DBA; esta aplicação só tem acesso de leitura):
+#   CREATE INDEX IX_PRLOT_Estabe_Produt_Lote ON PRLOT (Cod_Estabe, Cod_Produt, Cod_Lote)
+#       INCLUDE (Qtd_Saldo, Dat_Fabric, Dat_Vencim) WHERE Cod_Estabe = 0
+# As datas são comparadas como datas (parâmetros date ou NULL, ver parse_lote_date), por faixa
+# [dia, dia + 1) para ignorar uma eventual parte de hora, sem funções aplicadas à coluna:
+# assim o SQL Server pode usar um índice em vez de converter cada linha do lote para texto.
+SQL_VALIDA_SALDO_LOTE = """
+    WITH s AS (
+        SELECT Saldo = ISNULL(SUM(lt.Qtd_Saldo), 0)
+        FROM PRLOT lt
+        JOIN PRODU p ON lt.Cod_Produt = p.Codigo
+        WHERE lt.Cod_Estabe = 0
+          AND p.Cod_EAN = ?
+          AND ISNULL(lt.Cod_Lote, '*') = ?
+          AND ((? IS NULL AND lt.Dat_Fabric IS NULL) OR (lt.Dat_Fabric >= ? AND lt.Dat_Fabric < DATEADD(DAY, 1, ?)))
+          AND ((? IS NULL AND lt.Dat_Vencim IS NULL) OR (lt.Dat_Vencim >= ? AND lt.Dat_Vencim < DATEADD(DAY, 1, ?)))
+    )
+    SELECT ok = CASE WHEN s.Saldo >= ? THEN 1 ELSE 0 END, saldo = s.Saldo
+    FROM s
+"""
+
+# Multiplicador sugerido por unidade de venda (quantas unidades há em cada embalagem).
+# Unidades que não constam aqui usam multiplicador 1.
+MULTIPLICADOR_POR_UNIDADE = {
+    'CX': 30, # Exemplo: 1 caixa = 30 unidades
+    'FD': 10, # Exemplo: 1 fardo = 10 unidades
+}
+
+# --- Consultas SQL ---
+# As consultas executadas a cada leitura/requisição ficam definidas uma única vez aqui.
+# Reutilizar sempre o mesmo texto mantém o cache de instruções preparadas do sqlite3
+# (cached_statements em open_collection_conn) e o cache de planos do SQL Server aquecidos,
+# evitando reinterpretar e replanejar a mesma consulta a cada código de barras.
+
+# Query SQL para buscar TODOS os lotes de um produto pelo EAN.
+# A condição 'and lt.Qtd_Saldo > 0' foi REMOVIDA para permitir
+# a busca de produtos com saldo zero, conforme solicitado.
+# O multiplicador é inferido em Python a partir de p.Unidade_Venda (ver MULTIPLICADOR_POR_UNIDADE).
+# Seleciona apenas as colunas usadas por search_product: as junções com PRXES, DPXPR e FABRI
+# e a função dbo.FN_EAN13Ok só alimentavam colunas que não eram lidas. O agrupamento fica
+# restrito à chave do lote, somando o saldo de registros repetidos do mesmo lote.
+# Comentários de linha Python (#) foram removidos da string SQL para evitar erros de sintaxe no SQL Server.
+_SEARCH_PRODUCT_SQL = """
+    SELECT 
+        lt.Cod_Produt, 
+        Cod_Lote = ISNULL(lt.Cod_Lote, '*'), 
+        lt.Dat_Fabric,
+        lt.Dat_Vencim, 
+        QtdSld = SUM(lt.Qtd_Saldo),
+        p.Descricao, 
+        p.Unidade_Venda, 
+        p.Cod_EAN
+    FROM PRODU p
+    JOIN PRLOT lt ON (lt.Cod_Produt = p.Codigo)
+    WHERE lt.Cod_Estabe = 0
+      AND p.Tipo = '00'
+      AND {filtro_ean}
+    GROUP BY 
+        lt.Cod_Produt, 
+        lt.Cod_Lote, 
+        lt.Dat_Fabric,
+        lt.Dat_Vencim, 
+        p.Descricao, 
+        p.Unidade_Venda, 
+        p.Cod_EAN
+    ORDER BY lt.Cod_Lote, lt.Dat_Fabric, lt.Dat_Vencim
+"""
+SEARCH_PRODUCT_QUERY = _SEARCH_PRODUCT_SQL.format(filtro_ean='p.Cod_EAN = ?')
+# Mesma consulta para vários EANs (ver search_products_batch): {marcadores} recebe um '?' por código.
+SEARCH_PRODUCTS_BATCH_QUERY = _SEARCH_PRODUCT_SQL.format(filtro_ean='p.Cod_EAN IN ({marcadores})')
+
+# UPSERT de um item na coleta: insere ou soma a quantidade ao item com a mesma chave
+# (CodigoProduto, Lote, DataFabricacao, DataValidade), usando o índice único ux_coleta_key.
+SQL_UPSERT_COLETA = """
+    INSERT INTO ColetaEstoque (CodigoProduto, CodigoBarras, NomeProduto, Lote, DataFabricacao, DataValidade, QuantidadeBase, MultiplicadorUsado)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT (CodigoProduto, Lote, DataFabricacao, DataValidade)
+    DO UPDATE SET QuantidadeBase = QuantidadeBase + excluded.QuantidadeBase, DataHoraColeta = CAST(strftime('%s', 'now') AS INTEGER)
+"""
+# Cláusula RETURNING com as colunas de um item da coleta (ver COLETA_ITEM_KEYS). As rotas que
+# alteram um único item a usam para devolver ao frontend apenas esse item, e não a coleta inteira.
+SQL_RETURNING_COLETA_ITEM = """
+    RETURNING Id, CodigoProduto, CodigoBarras, NomeProduto, Lote, DataFabricacao, DataValidade, QuantidadeBase, MultiplicadorUsado,
+              QuantidadeBase * MultiplicadorUsado
+"""
+# Mesmo UPSERT, retornando o item resultante (usado quando a rota precisa devolver o item alterado).
+SQL_UPSERT_COLETA_RETURNING = SQL_UPSERT_COLETA + SQL_RETURNING_COLETA_ITEM
+
+# Lista completa da coleta, ordenada para facilitar o agrupamento visual no frontend.
+SQL_SELECT_COLETA_ORDENADA = """
+    SELECT Id, CodigoProduto, CodigoBarras, NomeProduto, Lote, DataFabricacao, DataValidade, QuantidadeBase, MultiplicadorUsado,
+           QuantidadeBase * MultiplicadorUsado
+    FROM ColetaEstoque ORDER BY CodigoProduto ASC, Lote ASC, DataFabricacao ASC, DataValidade ASC
+"""
+
+# Chaves JSON de um item da coleta, na mesma ordem das colunas de SQL_SELECT_COLETA_ORDENADA
+# e SQL_RETURNING_COLETA_ITEM; a quantidade total (base x multiplicador) já vem calculada do SQLite.
+# Os itens são montados com dict(zip(COLETA_ITEM_KEYS, row)), que roda inteiro em C.
+COLETA_ITEM_KEYS = (
+    'id', 'codigo_produto', 'codigo_barras', 'nome_produto', 'lote', 'data_fabricacao',
+    'data_validade', 'quantidade_base', 'multiplicador_usado', 'quantidade_total'
+)
+
+# Corpo JSON completo de /get_counted_products montado pelo próprio SQLite em uma única instrução,
+# sem converter cada linha em dict e re-serializar em Python. Formato compacto:
+#   {"schema": [nomes dos campos], "rows": [[valores na ordem do schema], ...], "rev": N}
+# Os nomes dos campos (COLETA_ITEM_KEYS) vão uma única vez em "schema", em vez de repetidos em
+# cada item; o frontend reconstrói os objetos (ver expandCountedProducts em script.js).
+# json() devolve o subtipo JSON ao array vindo da subconsulta, para que não seja embutido como texto.
+# Os parâmetros LIMIT/OFFSET permitem paginar a lista (LIMIT -1 devolve todos os itens).
+SQL_SELECT_COLETA_JSON = f"""
+    SELECT json_object(
+        'schema', json('{json.dumps(COLETA_ITEM_KEYS)}'),
+        'rows', json((
+            SELECT json_group_array(json_array(
+                Id, CodigoProduto, CodigoBarras, NomeProduto, Lote, DataFabricacao, DataValidade,
+                QuantidadeBase, MultiplicadorUsado, QuantidadeBase * MultiplicadorUsado
+            ))
+            FROM (
+                SELECT Id, CodigoProduto, CodigoBarras, NomeProduto, Lote, DataFabricacao, DataValidade, QuantidadeBase, MultiplicadorUsado
+                FROM ColetaEstoque ORDER BY CodigoProduto ASC, Lote ASC, DataFabricacao ASC, DataValidade ASC
+                LIMIT ? OFFSET ?
+            )
+        )),
+        'rev', (SELECT Rev FROM ColetaRevisao WHERE Id = 1)
+    )
+"""
+
+# Campos obrigatórios de um item enviado pelo frontend para /add_to_selected_lot(_bulk),
+# na mesma ordem das colunas de SQL_UPSERT_COLETA (ver parse_coleta_item).
+CAMPOS_ITEM_COLETA = ('codigo_produto', 'codigo_barras', 'nome_produto', 'lote', 'data_fabricacao', 'data_validade')
+
+# Campos obrigatórios da edição de um item (/update_counted_product), além das quantidades
+# (ver parse_coleta_edicao).
+CAMPOS_EDICAO_COLETA = ('id', 'lote', 'data_fabricacao', 'data_validade')
+
+# Edição de um item da coleta pela tela de edição.
+SQL_UPDATE_COLETA_ITEM = """
+    UPDATE ColetaEstoque SET 
+        QuantidadeBase = ?, 
+        MultiplicadorUsado = ?, 
+        Lote = ?, 
+        DataFabricacao = ?, 
+        DataValidade = ?, 
+        DataHoraColeta = CAST(strftime('%s', 'now') AS INTEGER)
+    WHERE Id = ?
+""" + SQL_RETURNING_COLETA_ITEM
+
+# Último lote contado de um produto (search_product), servido pelo índice ix_coleta_prod_when.
+# Os aliases já são as chaves esperadas pelo frontend (lido com sqlite3.Row e dict(row)).
+SQL_SELECT_ULTIMO_LOTE = """
+    SELECT Id AS id, -- ID do item na coleta (SQLite)
+           Lote AS lote,
+           DataFabricacao AS data_fabricacao,
+           DataValidade AS data_validade,
+           MultiplicadorUsado AS multiplicador_usado
+    FROM ColetaEstoque
+    WHERE CodigoProduto = ?
+    ORDER BY DataHoraColeta DESC
+    LIMIT 1
+"""
+
+# Dados de um item da coleta necessários para revalidar o saldo antes de incrementá-lo.
+SQL_SELECT_ITEM_PARA_INCREMENTO = """
+    SELECT CodigoBarras, NomeProduto, QuantidadeBase, Lote, DataFabricacao, DataValidade
+    FROM ColetaEstoque WHERE Id = ?
+"""
+
+# Incremento da quantidade de um item já contado (fluxo de contagem repetida do mesmo lote).
+# A soma é feita pelo próprio SQLite (QuantidadeBase + ?), então incrementos concorrentes do mesmo
+# item não se sobrescrevem. A condição "QuantidadeBase + ? <= saldo" reaplica, no instante da
+# gravação, o saldo obtido do SQL Server: se outro incremento passou na frente e o total excederia
+# o saldo (ou o item foi removido), nenhuma linha é alterada e o RETURNING volta vazio.
+# Parâmetros: (quantidade a adicionar, Id, quantidade a adicionar, saldo disponível).
+SQL_INCREMENTA_COLETA_ITEM = """
+    UPDATE ColetaEstoque SET QuantidadeBase = QuantidadeBase + ?, DataHoraColeta = CAST(strftime('%s', 'now') AS INTEGER)
+    WHERE Id = ? AND QuantidadeBase + ? <= ?
+""" + SQL_RETURNING_COLETA_ITEM
+
+# Linhas do arquivo de importação já no formato de texto fixo, na ordem em que foram coletadas.
+# A formatação é feita pelo próprio SQLite, sem passar cada campo pelo interpretador Python:
+#   CodigoProduto (14) + Quantidade total (6) + Lote (19) + DataValidade (10) + ' ' + DataFabricacao (10)
+# Os campos de texto são completados com espaços e truncados (substr conta caracteres, não bytes).
+# As datas, gravadas como YYYY-MM-DD, viram DD/MM/YYYY; datas vazias ou inválidas viram 10 espaços
+# (date(x, '+0 days') normaliza a data, então só é igual a x quando x é uma data válida).
+SQL_SELECT_EXPORTACAO = """
+    SELECT
+        substr(CodigoProduto || printf('%14s', ''), 1, 14)
+        || substr(CAST(QuantidadeBase * MultiplicadorUsado AS TEXT) || printf('%6s', ''), 1, 6)
+        || substr(Lote || printf('%19s', ''), 1, 19)
+        || CASE WHEN date(DataValidade, '+0 days') = DataValidade
+                THEN strftime('%d/%m/%Y', DataValidade) ELSE printf('%10s', '') END
+        || ' '
+        || CASE WHEN date(DataFabricacao, '+0 days') = DataFabricacao
+                THEN strftime('%d/%m/%Y', DataFabricacao) ELSE printf('%10s', '') END
+    FROM ColetaEstoque ORDER BY DataHoraColeta ASC
+"""
+
+# Quantidade de linhas lidas do SQLite e enviadas por vez ao transmitir o arquivo de importação.
+EXPORT_CHUNK_ROWS = 1000
+# Nível de compressão gzip do arquivo de importação (quando o navegador aceita gzip). O arquivo é
+# quase todo espaços de preenchimento, então o nível 1 já reduz bastante o tamanho gastando pouca CPU.
+EXPORT_GZIP_LEVEL = 1
+
+# Contador de revisão da coleta (ver bump_collection_rev).
+# Remoção de um item (devolve o Id removido) e limpeza de toda a coleta.
+SQL_DELETE_COLETA_ITEM = "DELETE FROM ColetaEstoque WHERE Id = ? RETURNING Id"
+SQL_CLEAR_COLETA = "DELETE FROM ColetaEstoque"
+# Remoção de vários itens de uma vez: os Ids chegam como um único parâmetro, uma lista JSON
+# expandida pelo json_each, de modo que o texto SQL é sempre o mesmo (e fica no cache de
+# instruções), qualquer que seja a quantidade de itens.
+SQL_DELETE_COLETA_ITENS = "DELETE FROM ColetaEstoque WHERE Id IN (SELECT value FROM json_each(?)) RETURNING Id"
+
+SQL_BUMP_REV = "UPDATE ColetaRevisao SET Rev = Rev + 1 WHERE Id = 1 RETURNING Rev"
+SQL_SELECT_REV = "SELECT Rev FROM ColetaRevisao WHERE Id = 1"
+
+# Cache local das buscas de produto (ver search_product). Durante a contagem o mesmo EAN é bipado
+# várias vezes; a partir da segunda leitura o produto e seus lotes vêm do SQLite, sem ida ao SQL Server.
+# O saldo exibido pode ficar defasado até PRODUCT_CACHE_TTL segundos, mas a validação de saldo
+# ao adicionar itens (validate_lot_saldo) continua sendo feita sempre no SQL Server.
+PRODUCT_CACHE_TTL = 15 * 60
+SQL_SELECT_PRODUTO_CACHE = "SELECT Payload, DataHoraCache FROM ProdutoCache WHERE CodigoBarras = ? AND DataHoraCache > ?"
+SQL_UPSERT_PRODUTO_CACHE = "INSERT OR REPLACE INTO ProdutoCache (CodigoBarras, Payload, DataHoraCache) VALUES (?, ?, ?)"
+SQL_DELETE_PRODUTO_CACHE = "DELETE FROM ProdutoCache WHERE CodigoBarras = ?"
+SQL_CLEAR_PRODUTO_CACHE = "DELETE FROM ProdutoCache"
+# Primeiro nível do cache, na memória do processo: {código de barras: (instante, payload)}.
+# Bipagens repetidas do mesmo EAN são atendidas por uma consulta a um dict, sem abrir o SQLite
+# nem desserializar o JSON. O cadastro do produto praticamente não muda durante uma contagem,
+# então o TTL é o mesmo do cache no SQLite (PRODUCT_CACHE_TTL), contado a partir da busca no
+# SQL Server (uma entrada vinda do SQLite guarda o instante original), e o tamanho comporta o catálogo
+# inteiro. Cada worker tem a sua cópia e /invalidate_product_cache limpa a do worker que a atende;
+# por isso a aplicação deve rodar com um único worker (ver o bloco __main__).
+PRODUCT_MEMORY_CACHE_TTL = PRODUCT_CACHE_TTL
+PRODUCT_MEMORY_CACHE_SIZE = 50000
+_produto_cache_memoria = {}
 
 def init_collection_db():
     """
     Inicializa o banco de dados SQLite para a coleta.
     Cria a tabela 'ColetaEstoque' se ela ainda não existir.
     Esta tabela armazena os detalhes dos produtos contados (lote, datas, quantidade, multiplicador).
+    Se o arquivo já está na versão COLLECTION_SCHEMA_VERSION (PRAGMA user_version), nada é feito:
+    cada worker/recarga do servidor faz apenas uma leitura, sem DDL nem lock de escrita.
+    Retorna True se o esquema está atualizado ao final, False se a criação/migração falhou.
     """
     conn = None
     try:
         conn = sqlite3.connect(COLLECTION_DB_PATH)
+        if conn.execute("PRAGMA user_version").fetchone()[0] >= COLLECTION_SCHEMA_VERSION:
+            return True # Esquema já atualizado
+        # PRAGMAs de desempenho. O journal_mode=WAL é persistido no próprio arquivo,
+        # então basta defini-lo aqui uma vez; leitores deixam de bloquear o escritor
+        # e cada gravação vira um append no log em vez do ciclo cria/fsync/apaga do journal.
+        if COLLECTION_DB_PATH != ':memory:': # Banco em memória não tem arquivo de log
+            conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL") # Em WAL, NORMAL é seguro e evita fsync a cada transação
+        conn.execute("PRAGMA temp_store=MEMORY") # Tabelas temporárias (ORDER BY, índices) em memória
+        conn.execute("PRAGMA cache_size=-20000") # ~20 MB de cache de páginas
+        conn.execute("PRAGMA mmap_size=268435456") # Até 256 MB do arquivo mapeados em memória
+        # auto_vacuum=INCREMENTAL: as páginas liberadas ao zerar a contagem podem ser devolvidas ao disco
+        # com PRAGMA incremental_vacuum (ver clear_counted_products). Num arquivo já existente o modo
+        # só passa a valer depois de um VACUUM, feito aqui uma única vez (fora de transação).
+        if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            conn.execute("VACUUM")
         cursor = conn.cursor()
+        # Toda a criação/migração do esquema em uma única transação. Com o lock de escrita obtido,
+        # confere de novo a versão: outro worker pode ter acabado de migrar o arquivo.
+        cursor.execute("BEGIN IMMEDIATE")
+        if cursor.execute("PRAGMA user_version").fetchone()[0] >= COLLECTION_SCHEMA_VERSION:
+            conn.rollback()
+            return True
+        # Migração: versões anteriores gravavam DataHoraColeta como texto (CURRENT_TIMESTAMP).
+        # A tabela antiga é renomeada, recriada abaixo com a coluna INTEGER (segundos Unix)
+        # e os dados são copiados convertendo o horário.
+        cursor.execute("PRAGMA table_info(ColetaEstoque)")
+        colunas = {col[1]: col[2].upper() for col in cursor.fetchall()}
+        migrar_data_hora = bool(colunas) and colunas.get('DataHoraColeta') != 'INTEGER'
+        if migrar_data_hora:
+            cursor.execute("ALTER TABLE ColetaEstoque RENAME TO ColetaEstoque_antiga")
         cursor.execute("""
             CREATE TABLE IF NOT EXISTS ColetaEstoque (
                 Id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -56,102 +457,637 @@ def init_collection_db():
                 DataValidade TEXT NOT NULL,
                 QuantidadeBase INTEGER NOT NULL DEFAULT 1,
                 MultiplicadorUsado INTEGER NOT NULL DEFAULT 1,
-                DataHoraColeta TEXT DEFAULT CURRENT_TIMESTAMP,
+                DataHoraColeta INTEGER DEFAULT (CAST(strftime('%s', 'now') AS INTEGER)),
                 UsuarioColeta TEXT NULL
             )
         """)
+        if migrar_data_hora:
+            cursor.execute("""
+                INSERT INTO ColetaEstoque (Id, CodigoProduto, CodigoBarras, NomeProduto, Lote, DataFabricacao, DataValidade,
+                                           QuantidadeBase, MultiplicadorUsado, DataHoraColeta, UsuarioColeta)
+                SELECT Id, CodigoProduto, CodigoBarras, NomeProduto, Lote, DataFabricacao, DataValidade,
+                       QuantidadeBase, MultiplicadorUsado, CAST(strftime('%s', DataHoraColeta) AS INTEGER), UsuarioColeta
+                FROM ColetaEstoque_antiga
+            """)
+            cursor.execute("DROP TABLE ColetaEstoque_antiga") # Leva junto os índices antigos, recriados abaixo
+        # Consolida eventuais itens duplicados de versões anteriores (mesmo produto, lote e datas)
+        # antes de criar o índice único, somando as quantidades no registro mais antigo.
+        # Se todos os registros do grupo usam o mesmo multiplicador, soma QuantidadeBase e mantém o
+        # multiplicador; se os multiplicadores diferem, grava o total em unidades
+        # (soma de QuantidadeBase * MultiplicadorUsado) com multiplicador 1, preservando a contagem.
+        cursor.execute("""
+            UPDATE ColetaEstoque SET (QuantidadeBase, MultiplicadorUsado) = (
+                SELECT CASE WHEN MIN(c2.MultiplicadorUsado) = MAX(c2.MultiplicadorUsado)
+                            THEN SUM(c2.QuantidadeBase) ELSE SUM(c2.QuantidadeBase * c2.MultiplicadorUsado) END,
+                       CASE WHEN MIN(c2.MultiplicadorUsado) = MAX(c2.MultiplicadorUsado)
+                            THEN MIN(c2.MultiplicadorUsado) ELSE 1 END
+                FROM ColetaEstoque c2
+                WHERE c2.CodigoProduto = ColetaEstoque.CodigoProduto AND c2.Lote = ColetaEstoque.Lote
+                  AND c2.DataFabricacao = ColetaEstoque.DataFabricacao AND c2.DataValidade = ColetaEstoque.DataValidade
+            )
+            WHERE Id IN (
+                SELECT MIN(Id) FROM ColetaEstoque
+                GROUP BY CodigoProduto, Lote, DataFabricacao, DataValidade
+                HAVING COUNT(*) > 1
+            )
+        """)
+        cursor.execute("""
+            DELETE FROM ColetaEstoque WHERE Id NOT IN (
+                SELECT MIN(Id) FROM ColetaEstoque
+                GROUP BY CodigoProduto, Lote, DataFabricacao, DataValidade
+            )
+        """)
+        # Índice único que identifica um item da coleta; usado pelo UPSERT (ON CONFLICT) em add_to_selected_lot.
+        cursor.execute("""
+            CREATE UNIQUE INDEX IF NOT EXISTS ux_coleta_key
+            ON ColetaEstoque (CodigoProduto, Lote, DataFabricacao, DataValidade)
+        """)
+        # Índice de cobertura da listagem: contém todas as colunas lidas por SQL_SELECT_COLETA_ORDENADA
+        # e SQL_SELECT_COLETA_JSON, já na ordem do ORDER BY. O SQLite percorre só as folhas do índice,
+        # em ordem, sem consultar a tabela nem ordenar.
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS ix_coleta_cov
+            ON ColetaEstoque (CodigoProduto, Lote, DataFabricacao, DataValidade, Id, CodigoBarras, NomeProduto, QuantidadeBase, MultiplicadorUsado)
+        """)
+        # Índice pela ordem de coleta, usado pelo arquivo de importação (ORDER BY DataHoraColeta).
+        cursor.execute("CREATE INDEX IF NOT EXISTS ix_coleta_ts ON ColetaEstoque (DataHoraColeta)")
+        # Índice do "último lote contado" de um produto (search_product): o SQLite desce direto
+        # na primeira folha de CodigoProduto, já ordenada por DataHoraColeta DESC, sem varrer nem ordenar.
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS ix_coleta_prod_when
+            ON ColetaEstoque (CodigoProduto, DataHoraColeta DESC)
+        """)
+        # Contador de revisão da coleta: incrementado a cada alteração para que o frontend saiba
+        # se a sua cópia local da tabela ainda está em dia ao aplicar apenas o item alterado.
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS ColetaRevisao (
+                Id INTEGER PRIMARY KEY CHECK (Id = 1),
+                Rev INTEGER NOT NULL DEFAULT 0
+            )
+        """)
+        cursor.execute("INSERT OR IGNORE INTO ColetaRevisao (Id, Rev) VALUES (1, 0)")
+        # Cache das buscas de produto no SQL Server: o JSON (produto + lotes) por código de barras,
+        # com o instante (epoch, em segundos) em que foi obtido para controle de validade.
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS ProdutoCache (
+                CodigoBarras TEXT PRIMARY KEY,
+                Payload TEXT NOT NULL,
+                DataHoraCache REAL NOT NULL
+            )
+        """)
+        cursor.execute(f"PRAGMA user_version = {COLLECTION_SCHEMA_VERSION}")
         conn.commit() # Confirma as alterações no banco de dados
+        return True
     except sqlite3.Error as e:
         # Captura e imprime erros específicos do SQLite
         print(f"Erro ao inicializar o banco de dados de coleta SQLite: {e}")
+        return False
     finally:
         if conn:
             conn.close() # Garante que a conexão seja fechada, mesmo em caso de erro
 
+def open_collection_conn():
+    """
+    Abre uma conexão com o banco de dados SQLite da coleta.
+    Todas as rotas devem usar esta função em vez de chamar sqlite3.connect() diretamente,
+    pois ela aplica os PRAGMAs que valem apenas por conexão (o journal_mode=WAL
+    já fica gravado no arquivo pelo init_collection_db()).
+    A conexão opera em modo autocommit; escritas devem abrir explicitamente
+    "BEGIN IMMEDIATE" e terminar com "COMMIT".
+    """
+    # isolation_level=None desliga as transações implícitas do módulo sqlite3: cada escrita
+    # controla sua própria transação com BEGIN IMMEDIATE / COMMIT (um único fsync por lote).
+    # cached_statements=256 amplia o cache interno de instruções preparadas do sqlite3,
+    # para que todas as consultas SQL_* deste módulo permaneçam compiladas entre execuções.
+    conn = sqlite3.connect(COLLECTION_DB_PATH, check_same_thread=False, isolation_level=None, cached_statements=256)
+    conn.execute("PRAGMA synchronous=NORMAL") # Em WAL, NORMAL é seguro e evita fsync a cada transação
+    conn.execute("PRAGMA busy_timeout=5000") # Aguarda até 5s pelo lock de escrita em vez de falhar com "database is locked"
+    conn.execute("PRAGMA temp_store=MEMORY") # Tabelas temporárias (ORDER BY, índices) em memória
+    conn.execute("PRAGMA cache_size=-20000") # ~20 MB de cache de páginas, mantido enquanto a conexão estiver no pool
+    conn.execute("PRAGMA mmap_size=268435456") # Até 256 MB do arquivo mapeados em memória
+    return conn
+
+def get_coll_db():
+    """
+    Retorna a conexão SQLite da coleta associada à requisição atual (armazenada em flask.g).
+    Na primeira chamada da requisição a conexão é retirada do pool (ou aberta, se o pool estiver
+    vazio) e reaproveitada por todas as consultas da mesma requisição; close_coll_db() a devolve
+    ao pool ao final do contexto.
+    """
+    if 'coll' not in g:
+        try:
+            g.coll = collection_pool.get_nowait()
+        except queue.Empty:
+            g.coll = open_collection_conn()
+    return g.coll
+
+def bump_collection_rev(cursor):
+    """
+    Incrementa o contador de revisão da coleta e retorna o novo valor.
+    Deve ser chamada na mesma transação de cada alteração em ColetaEstoque.
+    """
+    cursor.execute(SQL_BUMP_REV)
+    return cursor.fetchone()[0]
+
+@app.teardown_appcontext
+def close_coll_db(exception):
+    """
+    Devolve a conexão SQLite da coleta ao pool ao final do contexto da aplicação (fim da requisição).
+    Uma transação deixada aberta por um erro é desfeita antes; se o pool estiver cheio, a conexão é fechada.
+    """
+    conn = g.pop('coll', None)
+    if conn is None:
+        return
+    try:
+        if conn.in_transaction:
+            conn.rollback()
+        collection_pool.put_nowait(conn)
+    except (sqlite3.Error, queue.Full):
+        conn.close()
+
 # Chama a função de inicialização do DB de coleta ao iniciar a aplicação Flask.
 # Isso garante que o arquivo 'coleta_estoque.db' e a tabela 'ColetaEstoque' existam
-# antes que qualquer rota tente acessá-los.
+# antes que qualquer rota tente acessá-los. Continua aqui mesmo com o comando 'init-db' (abaixo):
+# depois da primeira migração custa apenas a leitura do PRAGMA user_version, e garante o esquema
+# em instalações que sobem o servidor sem rodar o comando antes.
 with app.app_context():
     init_collection_db()
 
+@app.cli.command('init-db')
+def init_db_command():
+    """
+    Cria ou atualiza o esquema do banco de coleta (SQLite) e sai: flask --app app init-db
+    Rodar uma vez na implantação, antes de subir os workers, deixa a verificação feita na
+    importação do módulo reduzida à leitura do PRAGMA user_version. Termina com código de saída 1
+    se a criação/migração falhar (o erro já foi impresso por init_collection_db).
+    """
+    if not init_collection_db():
+        raise SystemExit(1)
+    print(f"Banco de coleta pronto: {COLLECTION_DB_PATH} (versão {COLLECTION_SCHEMA_VERSION}).")
+
 # --- Funções para Gerenciar o Arquivo de Configuração do DB SQL Server ---
 def load_db_config():
     """
     Carrega as configurações de conexão do SQL Server de um arquivo JSON (db_config.json).
-    Usa um lock para acesso seguro ao arquivo e trata erros de leitura/parsing JSON.
+    Retorna a cópia em cache se o arquivo não foi modificado desde a última leitura.
+    Não usa lock: save_db_config() troca o arquivo de forma atômica (os.replace), e uma leitura
+    que pegue o arquivo no meio de uma edição manual é repetida uma vez antes de ser tratada como erro.
     """
-    with db_config_lock:
-        if os.path.exists(DB_CONFIG_FILE):
+    if os.path.exists(DB_CONFIG_FILE):
+        try:
+            mtime = os.stat(DB_CONFIG_FILE).st_mtime_ns
+            cached_mtime, cached_data = _db_cfg_cache['entry']
+            if mtime == cached_mtime and cached_data is not None:
+                return cached_data
             try:
                 with open(DB_CONFIG_FILE, 'r') as f:
-                    return json.load(f)
+                    config_data = json.load(f)
             except json.JSONDecodeError:
-                # Erro comum: arquivo JSON corrompido ou mal formatado
-                print(f"Erro: Arquivo {DB_CONFIG_FILE} está corrompido ou mal formatado.")
-                return None
-            except IOError as e:
-                # Erro de I/O ao tentar ler o arquivo
-                print(f"Erro de I/O ao ler {DB_CONFIG_FILE}: {e}")
-                return None
-        return None
+                time.sleep(0.001) # Arquivo possivelmente sendo gravado; tenta mais uma vez
+                mtime = os.stat(DB_CONFIG_FILE).st_mtime_ns
+                with open(DB_CONFIG_FILE, 'r') as f:
+                    config_data = json.load(f)
+            _db_cfg_cache['entry'] = (mtime, config_data)
+            return config_data
+        except json.JSONDecodeError:
+            # Erro comum: arquivo JSON corrompido ou mal formatado
+            print(f"Erro: Arquivo {DB_CONFIG_FILE} está corrompido ou mal formatado.")
+            return None
+        except IOError as e:
+            # Erro de I/O ao tentar ler o arquivo
+            print(f"Erro de I/O ao ler {DB_CONFIG_FILE}: {e}")
+            return None
+    return None
 
 def save_db_config(config_data):
     """
     Salva as configurações de conexão do SQL Server em um arquivo JSON.
-    Usa um lock para acesso seguro ao arquivo e trata erros de escrita.
+    O conteúdo é gravado primeiro em um arquivo temporário e depois substitui o db_config.json
+    de forma atômica, para que um leitor nunca veja o arquivo pela metade.
     """
-    with db_config_lock:
+    tmp_file = f"{DB_CONFIG_FILE}.{threading.get_ident()}.tmp" # Um temporário por thread
+    try:
+        with open(tmp_file, 'w') as f:
+            json.dump(config_data, f, indent=4) # Salva com indentação para legibilidade
+        os.replace(tmp_file, DB_CONFIG_FILE)
+        _db_cfg_cache['entry'] = (0, None) # Força a releitura do arquivo na próxima chamada de load_db_config()
+        return True
+    except IOError as e:
+        # Erro de I/O ao tentar escrever no arquivo
+        print(f"Erro ao salvar configurações do DB: {e}")
         try:
-            with open(DB_CONFIG_FILE, 'w') as f:
-                json.dump(config_data, f, indent=4) # Salva com indentação para legibilidade
-            return True
-        except IOError as e:
-            # Erro de I/O ao tentar escrever no arquivo
-            print(f"Erro ao salvar configurações do DB: {e}")
-            return False
+            os.remove(tmp_file)
+        except OSError:
+            pass
+        return False
+
+def flash_connection_error(message):
+    """
+    Registra uma mensagem de erro de conexão para o usuário (flash), se houver uma requisição em andamento.
+    """
+    if has_request_context():
+        flash(message, 'danger')
 
 def get_sqlserver_connection():
     """
     Estabelece uma conexão com o banco de dados SQL Server usando as configurações salvas.
     Este banco de dados é usado apenas para consulta (leitura) de produtos.
-    Trata erros de conexão e credenciais.
+    Trata erros de conexão e credenciais. As mensagens para o usuário (flash) só são registradas
+    quando há uma requisição em andamento; fora dela (ex.: thread de keepalive) ficam apenas no console.
     """
     db_config = load_db_config()
     if not db_config:
         print("Erro: Configurações do banco de dados SQL Server não encontradas ou inválidas.")
-        flash('As configurações do banco de dados SQL Server não foram encontradas ou estão inválidas. Por favor, configure-as.', 'danger')
+        flash_connection_error('As configurações do banco de dados SQL Server não foram encontradas ou estão inválidas. Por favor, configure-as.')
         return None
 
-    # Verifica se todas as chaves necessárias estão presentes e não vazias.
-    # Isso previne NameError ou KeyError se a configuração estiver incompleta.
-    required_keys = ['server', 'database', 'username', 'password', 'driver']
-    if not all(key in db_config and db_config[key] for key in required_keys):
-        flash('Algumas configurações do banco de dados SQL Server estão faltando ou vazias. Por favor, verifique.', 'danger')
-        return None
+    if db_config is not _sqlserver_conn_str_cache['config']:
+        # Verifica se todas as chaves necessárias estão presentes e não vazias.
+        # Isso previne NameError ou KeyError se a configuração estiver incompleta.
+        if not is_db_config_complete(db_config):
+            flash_connection_error('Algumas configurações do banco de dados SQL Server estão faltando ou vazias. Por favor, verifique.')
+            return None
+        # A configuração mudou: monta a nova string de conexão e descarta as conexões antigas do pool.
+        _sqlserver_conn_str_cache['conn_str'] = build_sqlserver_conn_str(db_config)
+        _sqlserver_conn_str_cache['config'] = db_config
+        clear_sqlserver_pool()
+
+    # Reaproveita uma conexão já aberta do pool, descartando as que caíram enquanto estavam ociosas.
+    while True:
+        try:
+            conn = sqlserver_pool.get_nowait()
+        except queue.Empty:
+            break
+        if is_sqlserver_connection_alive(conn):
+            return conn
+        discard_sqlserver_connection(conn) # A conexão já está quebrada; basta descartá-la
 
     try:
-        # Constrói a string de conexão pyodbc
-        conn_str = (
-            f"DRIVER={db_config.get('driver')};"
-            f"SERVER={db_config.get('server')};"
-            f"DATABASE={db_config.get('database')};"
-            f"UID={db_config.get('username')};"
-            f"PWD={db_config.get('password')}"
-        )
-        conn = pyodbc.connect(conn_str)
+        # autocommit=True: as consultas são apenas de leitura, e assim nenhuma conexão
+        # devolvida ao pool fica com uma transação aberta.
+        conn = pyodbc.connect(_sqlserver_conn_str_cache['conn_str'], autocommit=True)
+        # Suprime as mensagens de "linhas afetadas" (DONE_IN_PROC) em todas as consultas da sessão.
+        conn.execute("SET NOCOUNT ON")
         return conn
     except pyodbc.Error as ex:
         # Captura erros específicos do pyodbc (problemas de conexão, credenciais, driver)
         sqlstate = ex.args[0]
         print(f"Erro ao conectar ao banco de dados SQL Server: {sqlstate} - {ex}")
-        flash(f'Erro ao conectar ao banco de dados SQL Server: {ex}', 'danger')
+        flash_connection_error(f'Erro ao conectar ao banco de dados SQL Server: {ex}')
         return None
     except Exception as e:
         # Captura quaisquer outros erros inesperados durante a conexão
         print(f"Erro inesperado ao tentar conectar ao banco de dados SQL Server: {e}")
-        flash(f'Erro inesperado ao conectar ao banco de dados SQL Server: {e}', 'danger')
+        flash_connection_error(f'Erro inesperado ao conectar ao banco de dados SQL Server: {e}')
         return None
 
+def is_db_config_complete(db_config):
+    """
+    Indica se a configuração do SQL Server tem todas as chaves necessárias preenchidas.
+    """
+    required_keys = ['server', 'database', 'username', 'password', 'driver']
+    return bool(db_config) and all(key in db_config and db_config[key] for key in required_keys)
+
+def build_sqlserver_conn_str(db_config):
+    """
+    Constrói a string de conexão pyodbc a partir de um dicionário de configurações do SQL Server.
+    """
+    return (
+        f"DRIVER={db_config.get('driver')};"
+        f"SERVER={db_config.get('server')};"
+        f"DATABASE={db_config.get('database')};"
+        f"UID={db_config.get('username')};"
+        f"PWD={db_config.get('password')}"
+    )
+
+def is_sqlserver_connection_alive(conn):
+    """
+    Verifica com um "SELECT 1" rápido se uma conexão do pool ainda está utilizável
+    (o servidor pode ter encerrado conexões ociosas ou a rede pode ter caído).
+    """
+    previous_timeout = conn.timeout
+    try:
+        conn.timeout = SQLSERVER_PING_TIMEOUT
+        conn.execute("SELECT 1").fetchone()
+        return True
+    except pyodbc.Error:
+        return False
+    finally:
+        try:
+            conn.timeout = previous_timeout
+        except pyodbc.Error:
+            pass
+
+def release_sqlserver_connection(conn):
+    """
+    Devolve uma conexão SQL Server ao pool para ser reutilizada pela próxima requisição.
+    Se o pool já estiver cheio, a conexão excedente é simplesmente fechada.
+    """
+    try:
+        sqlserver_pool.put_nowait(conn)
+    except queue.Full:
+        discard_sqlserver_connection(conn)
+
+def discard_sqlserver_connection(conn):
+    """
+    Fecha definitivamente uma conexão SQL Server e esquece os cursores guardados para ela.
+    """
+    _sqlserver_cursors.pop(conn, None)
+    try:
+        conn.close()
+    except pyodbc.Error:
+        pass # A conexão já pode estar quebrada; o importante é descartá-la
+
+def get_sqlserver_cursor(conn, name):
+    """
+    Retorna o cursor reservado para a consulta 'name' nesta conexão, criando-o na primeira vez.
+    O pyodbc reaproveita a instrução já preparada quando o mesmo cursor executa o mesmo texto SQL,
+    então cada consulta frequente (busca de produto, validação de saldo) mantém seu próprio cursor
+    e não é preparada de novo a cada leitura.
+    """
+    cursors = _sqlserver_cursors.setdefault(conn, {})
+    cursor = cursors.get(name)
+    if cursor is None:
+        cursor = cursors[name] = conn.cursor()
+        cursor.arraysize = SQLSERVER_FETCH_ROWS # Tamanho padrão de fetchmany() neste cursor
+    return cursor
+
+@contextmanager
+def sqlserver_conn():
+    """
+    Empresta uma conexão do pool do SQL Server pelo tempo de um bloco 'with'.
+    Entrega None se não for possível conectar (a mensagem de erro já foi registrada por
+    get_sqlserver_connection). Ao sair do bloco a conexão volta ao pool; se o bloco terminou
+    com um erro do pyodbc, ela é fechada em vez de devolvida, pois pode ter ficado inutilizável.
+    """
+    conn = get_sqlserver_connection()
+    try:
+        yield conn
+    except pyodbc.Error:
+        if conn is not None:
+            discard_sqlserver_connection(conn)
+            conn = None
+        raise
+    finally:
+        if conn is not None:
+            release_sqlserver_connection(conn)
+
+def parse_lote_date(value):
+    """
+    Converte uma data de lote no formato YYYY-MM-DD (como enviada pelo frontend) em datetime.date.
+    String vazia ou None representam data ausente (NULL no SQL Server) e viram None.
+    Lança ValueError com a mensagem para o usuário se a data não estiver nesse formato.
+    """
+    if not value:
+        return None
+    try:
+        # len == 10: o fromisoformat também aceitaria formatos como 'YYYYMMDD', que não são gravados na coleta.
+        if isinstance(value, str) and len(value) == 10:
+            return date.fromisoformat(value)
+    except ValueError:
+        pass
+    raise ValueError(f'Data de lote inválida: "{value}". Use o formato AAAA-MM-DD.')
+
+def validate_lot_saldo(sql_cursor, codigo_barras, lote, data_fabricacao, data_validade, quantidade):
+    """
+    Verifica no SQL Server, em uma única consulta, se o saldo atual de um lote comporta a quantidade informada.
+    Retorna a tupla (ok, saldo): ok indica se quantidade <= saldo; saldo é 0 quando o lote não é encontrado.
+    Erros do pyodbc e o ValueError de uma data inválida (ver parse_lote_date) são propagados para a rota.
+    """
+    data_fabricacao = parse_lote_date(data_fabricacao)
+    data_validade = parse_lote_date(data_validade)
+    sql_cursor.execute(SQL_VALIDA_SALDO_LOTE, codigo_barras, lote,
+                       data_fabricacao, data_fabricacao, data_fabricacao,
+                       data_validade, data_validade, data_validade,
+                       quantidade)
+    # fetchall() (e não fetchone) lê o resultado até o fim: como o cursor é reaproveitado e não fechado,
+    # um resultado pendente deixaria a conexão "ocupada" para os demais cursores (sem MARS).
+    row = sql_cursor.fetchall()[0]
+    return bool(row.ok), row.saldo
+
+def parse_coleta_item(data):
+    """
+    Valida e converte um item enviado pelo frontend para /add_to_selected_lot(_bulk).
+    Retorna (campos, quantidade_base, multiplicador), onde campos é a tupla CAMPOS_ITEM_COLETA
+    já na ordem das colunas do UPSERT. Lança ValueError com a mensagem para o usuário se algo for inválido.
+    """
+    if not isinstance(data, dict):
+        raise ValueError('Item inválido.')
+    # Extrai todos os campos obrigatórios em uma única passada (map sobre dict.get roda em C).
+    fields = tuple(map(data.get, CAMPOS_ITEM_COLETA))
+    try:
+        quantidade_base = int(data.get('quantidade_base', 0)) # Quantidade base que o usuário quer adicionar
+        multiplicador = int(data.get('multiplicador_sugerido', 1))
+    except (TypeError, ValueError):
+        raise ValueError('Quantidade base ou multiplicador inválido.')
+    # Valida se todos os campos obrigatórios estão presentes
+    if not all(fields):
+        raise ValueError('Todos os campos do produto e lote são obrigatórios.')
+    # Valida se a quantidade a adicionar é positiva
+    if quantidade_base <= 0:
+        raise ValueError('A quantidade a adicionar deve ser maior que zero.')
+    # As datas do lote são gravadas na coleta como YYYY-MM-DD (ver SQL_SELECT_EXPORTACAO).
+    parse_lote_date(fields[4])
+    parse_lote_date(fields[5])
+    return fields, quantidade_base, multiplicador
+
+def parse_coleta_edicao(data):
+    """
+    Valida e converte a edição de um item enviada pelo frontend para /update_counted_product.
+    Retorna (item_id, lote, data_fabricacao, data_validade, quantidade_base, multiplicador_usado).
+    Lança ValueError com a mensagem para o usuário se algo for inválido.
+    """
+    if not isinstance(data, dict):
+        raise ValueError('Dados inválidos.')
+    item_id, lote, data_fabricacao, data_validade = map(data.get, CAMPOS_EDICAO_COLETA)
+    try:
+        quantidade_base = int(data.get('quantidade_base', 0))
+        multiplicador_usado = int(data.get('multiplicador_usado', 1))
+    except (TypeError, ValueError):
+        raise ValueError('Quantidade base ou multiplicador inválido.')
+    # Valida se todos os campos obrigatórios estão presentes.
+    if not (item_id and lote and data_fabricacao and data_validade):
+        raise ValueError('Todos os campos são obrigatórios para atualização.')
+    # Valida se quantidade_base e multiplicador_usado são positivos.
+    if quantidade_base <= 0 or multiplicador_usado <= 0:
+        raise ValueError('Quantidade base e multiplicador devem ser números positivos.')
+    # As datas são gravadas na coleta como YYYY-MM-DD e reutilizadas na validação de saldo.
+    parse_lote_date(data_fabricacao)
+    parse_lote_date(data_validade)
+    return item_id, lote, data_fabricacao, data_validade, quantidade_base, multiplicador_usado
+
+def clear_sqlserver_pool():
+    """
+    Fecha e descarta todas as conexões do pool do SQL Server.
+    Usado quando as configurações do banco mudam, para que nenhuma conexão antiga seja reutilizada.
+    """
+    while True:
+        try:
+            conn = sqlserver_pool.get_nowait()
+        except queue.Empty:
+            break
+        discard_sqlserver_connection(conn)
+
+def clear_product_cache(codigo_barras=None):
+    """
+    Remove do cache local (memória deste processo e SQLite) as buscas de produto: apenas a do
+    código de barras informado, ou todas quando nenhum é informado. Retorna a quantidade de
+    entradas removidas do SQLite.
+    """
+    conn = get_coll_db()
+    if codigo_barras:
+        _produto_cache_memoria.pop(codigo_barras, None)
+        return conn.execute(SQL_DELETE_PRODUTO_CACHE, (codigo_barras,)).rowcount
+    _produto_cache_memoria.clear()
+    return conn.execute(SQL_CLEAR_PRODUTO_CACHE).rowcount
+
+def cache_product_in_memory(codigo_barras, payload, cached_at=None):
+    """
+    Guarda o produto e seus lotes no cache em memória (ver PRODUCT_MEMORY_CACHE_TTL).
+    'cached_at' é o instante em que os dados foram lidos do SQL Server (padrão: agora), para que
+    uma entrada copiada do cache no SQLite não ganhe um novo prazo de validade.
+    Ao atingir PRODUCT_MEMORY_CACHE_SIZE entradas, descarta a mais antiga (ordem de inserção do dict).
+    """
+    _produto_cache_memoria.pop(codigo_barras, None) # Reinsere no fim da ordem
+    if len(_produto_cache_memoria) >= PRODUCT_MEMORY_CACHE_SIZE:
+        try:
+            del _produto_cache_memoria[next(iter(_produto_cache_memoria))]
+        except (StopIteration, KeyError, RuntimeError):
+            pass # Outra thread alterou o cache ao mesmo tempo; a limpeza fica para a próxima inserção
+    _produto_cache_memoria[codigo_barras] = (time.time() if cached_at is None else cached_at, payload)
+
+def product_from_row(row):
+    """
+    Dados comuns do produto (iguais em todos os lotes) a partir de uma linha de SEARCH_PRODUCT_QUERY.
+    """
+    return {
+        'codigo_produto': row.Cod_Produt,
+        'codigo_barras': row.Cod_EAN,
+        'nome_produto': row.Descricao,
+        'multiplicador_sugerido': MULTIPLICADOR_POR_UNIDADE.get(row.Unidade_Venda, 1),
+        'unidade_venda': row.Unidade_Venda
+    }
+
+def lote_from_row(row):
+    """
+    Detalhes de um lote a partir de uma linha de SEARCH_PRODUCT_QUERY.
+    As datas vão como YYYY-MM-DD ou string vazia se NULL (isoformat() serve para date e datetime).
+    """
+    return {
+        'lote': row.Cod_Lote,
+        'data_fabricacao': row.Dat_Fabric.isoformat()[:10] if row.Dat_Fabric else '',
+        'data_validade': row.Dat_Vencim.isoformat()[:10] if row.Dat_Vencim else '',
+        'saldo_disponivel': row.QtdSld # Saldo disponível para este lote
+    }
+
+def get_cached_product(barcode):
+    """
+    Procura o produto e seus lotes ({'product': ..., 'lotes': [...]}) nos caches locais:
+    primeiro na memória do processo, depois no SQLite (ProdutoCache). Retorna None se não estiver
+    em cache ou se a entrada já expirou.
+    """
+    entrada = _produto_cache_memoria.get(barcode)
+    if entrada and entrada[0] > time.time() - PRODUCT_MEMORY_CACHE_TTL:
+        return entrada[1]
+    try:
+        row = get_coll_db().execute(SQL_SELECT_PRODUTO_CACHE, (barcode, time.time() - PRODUCT_CACHE_TTL)).fetchone()
+        if row:
+            payload = app.json.loads(row[0]) # Usa o mesmo serializador das respostas (orjson, se instalado)
+            cache_product_in_memory(barcode, payload, cached_at=row[1]) # Mantém o instante da busca original
+            return payload
+    except (sqlite3.Error, ValueError) as e:
+        print(f"Erro ao ler o cache de produtos: {e}")
+        # Em caso de falha no cache, segue normalmente com a busca no SQL Server.
+    return None
+
+def store_product_cache(barcode, payload):
+    """
+    Guarda o produto e seus lotes nos caches (memória e SQLite) para as próximas leituras do mesmo EAN.
+    """
+    agora = time.time() # Mesmo instante nos dois níveis: ambos expiram juntos
+    cache_product_in_memory(barcode, payload, cached_at=agora)
+    try:
+        get_coll_db().execute(SQL_UPSERT_PRODUTO_CACHE, (barcode, app.json.dumps(payload), agora))
+    except sqlite3.Error as e:
+        print(f"Erro ao gravar o cache de produtos: {e}")
+
+def get_last_counted_lot(codigo_produto):
+    """
+    Retorna o último lote contado do produto na coleta (SQLite), ou None.
+    Não passa pelo cache: reflete sempre o estado atual da coleta.
+    """
+    try:
+        sqlite_cursor = get_coll_db().cursor()
+        # sqlite3.Row + aliases com os nomes esperados pelo frontend: dict(row) monta o
+        # dicionário direto em C, sem acessar cada coluna pelo índice.
+        sqlite_cursor.row_factory = sqlite3.Row
+        sqlite_cursor.execute(SQL_SELECT_ULTIMO_LOTE, (codigo_produto,))
+        last_lot_row = sqlite_cursor.fetchone()
+        return dict(last_lot_row) if last_lot_row else None
+    except sqlite3.Error as e:
+        print(f"Erro ao buscar último lote contado no SQLite: {e}")
+        # Não impede a busca principal, apenas loga o erro no console do servidor.
+        return None
+
+def warm_up_sqlserver_pool():
+    """
+    Abre uma conexão com o SQL Server e a deixa no pool, para que a próxima busca de produto
+    não pague o carregamento do driver, o handshake e o login. Retorna False se não conseguiu conectar.
+    """
+    conn = get_sqlserver_connection()
+    if conn is None:
+        return False
+    release_sqlserver_connection(conn)
+    return True
+
+def sqlserver_keepalive_loop(interval):
+    """
+    Laço da thread de keepalive do SQL Server (ver SQLSERVER_KEEPALIVE_INTERVAL em config.py).
+    A cada 'interval' segundos testa as conexões ociosas do pool, descartando as que caíram,
+    e reabre uma conexão se o pool ficou vazio. Enquanto o banco não está configurado ou não aceita
+    conexões, a espera dobra a cada tentativa (até SQLSERVER_KEEPALIVE_MAX_BACKOFF), para não
+    repetir o mesmo erro no console a cada intervalo.
+    """
+    falhas = 0
+    aviso_sem_config = False
+    while True:
+        try:
+            if not is_db_config_complete(load_db_config()):
+                # Banco ainda não configurado (ver /settings): nada a testar, avisa uma única vez.
+                if not aviso_sem_config:
+                    print("Keepalive do SQL Server aguardando a configuração do banco de dados.")
+                    aviso_sem_config = True
+                falhas += 1
+            else:
+                aviso_sem_config = False
+                if sqlserver_pool.empty() and not warm_up_sqlserver_pool():
+                    falhas += 1
+                else:
+                    falhas = 0
+                    # Testa uma conexão de cada vez: as demais continuam disponíveis para as requisições.
+                    for _ in range(sqlserver_pool.qsize()):
+                        try:
+                            conn = sqlserver_pool.get_nowait()
+                        except queue.Empty:
+                            break
+                        if is_sqlserver_connection_alive(conn):
+                            release_sqlserver_connection(conn)
+                        else:
+                            discard_sqlserver_connection(conn)
+        except Exception as e:
+            # A thread não pode morrer por causa de um erro inesperado; tenta de novo no próximo ciclo.
+            print(f"Erro no keepalive das conexões SQL Server: {e}")
+            falhas += 1
+        falhas = min(falhas, 16) # Limita o expoente; a espera já fica presa em SQLSERVER_KEEPALIVE_MAX_BACKOFF
+        time.sleep(min(interval * 2 ** falhas, SQLSERVER_KEEPALIVE_MAX_BACKOFF))
+
+# Inicia o keepalive em segundo plano, se habilitado. A thread (e a conexão que ela abre) é criada na
+# importação e não sobrevive ao fork dos workers: com 'gunicorn --preload' deixe SQLSERVER_KEEPALIVE_INTERVAL
+# em 0 (ver o bloco __main__).
+if app.config['SQLSERVER_KEEPALIVE_INTERVAL'] > 0:
+    threading.Thread(target=sqlserver_keepalive_loop, args=(app.config['SQLSERVER_KEEPALIVE_INTERVAL'],),
+                     name='sqlserver-keepalive', daemon=True).start()
+
 # --- Rotas da Aplicação Flask ---
 
 @app.route('/')
@@ -202,18 +1138,17 @@ def settings():
         try:
             # Tenta conectar ao SQL Server com as novas configurações para testá-las.
             # Um teste de conexão é crucial para validar as credenciais antes de salvá-las.
-            temp_conn_str = (
-                f"DRIVER={new_config['driver']};"
-                f"SERVER={new_config['server']};"
-                f"DATABASE={new_config['database']};"
-                f"UID={new_config['username']};"
-                f"PWD={new_config['password']}"
-            )
+            temp_conn_str = build_sqlserver_conn_str(new_config)
             temp_conn = pyodbc.connect(temp_conn_str, timeout=5) # Timeout para não travar a aplicação
             temp_conn.close() # Fecha a conexão de teste imediatamente
 
             # Se a conexão de teste for bem-sucedida, salva as configurações.
             if save_db_config(new_config):
+                clear_sqlserver_pool() # Descarta conexões abertas com as credenciais antigas
+                try:
+                    clear_product_cache() # Produtos em cache podem ser de outro banco
+                except sqlite3.Error as e:
+                    print(f"Erro ao limpar o cache de produtos: {e}")
                 flash('Configurações do banco de dados SQL Server salvas e testadas com sucesso!', 'success')
                 return redirect(url_for('index')) # Redireciona para a página inicial após sucesso
             else:
@@ -231,6 +1166,26 @@ def settings():
     # Para requisições GET, apenas renderiza a página de configurações com os dados atuais
     return render_template('settings.html', config=config_data)
 
+@app.route('/health/db', methods=['GET'])
+def health_db():
+    """
+    Rota de verificação (monitoramento): testa com "SELECT 1" uma conexão do pool do SQL Server
+    e informa o tempo de resposta. 'status' indica o estado: 'ok', 'not_configured' (configuração
+    do banco ainda não salva em /settings; não é tratado como erro) ou 'unavailable' (503).
+    """
+    if not is_db_config_complete(load_db_config()):
+        return jsonify({'success': False, 'status': 'not_configured', 'message': 'SQL Server ainda não configurado.'})
+    inicio = time.perf_counter()
+    sql_conn = get_sqlserver_connection()
+    if sql_conn is None:
+        return jsonify({'success': False, 'status': 'unavailable', 'message': 'SQL Server indisponível.'}), 503
+    if not is_sqlserver_connection_alive(sql_conn):
+        # A conexão não respondeu ao "SELECT 1": é fechada em vez de voltar ao pool.
+        discard_sqlserver_connection(sql_conn)
+        return jsonify({'success': False, 'status': 'unavailable', 'message': 'SQL Server indisponível.'}), 503
+    release_sqlserver_connection(sql_conn)
+    return jsonify({'success': True, 'status': 'ok', 'latency_ms': round((time.perf_counter() - inicio) * 1000, 1)})
+
 @app.route('/search_product', methods=['POST'])
 def search_product():
     """
@@ -242,141 +1197,158 @@ def search_product():
     if not barcode:
         # Validação de entrada: código de barras é obrigatório
         return jsonify({'success': False, 'message': 'Código de barras não fornecido.'}), 400
+    if len(barcode) > SEARCH_BARCODE_MAX_LEN:
+        # Não cabe no parâmetro VARCHAR da busca (SEARCH_BARCODE_INPUT_SIZES): nenhum produto tem esse código.
+        return jsonify({'success': False, 'message': 'Produto não encontrado com este código de barras ou critérios.'})
 
-    sql_conn = get_sqlserver_connection()
-    if not sql_conn:
-        # Se não conseguir conectar ao SQL Server, retorna erro.
-        return jsonify({'success': False, 'message': 'Não foi possível conectar ao banco de dados SQL Server. Verifique as configurações.'}), 500
+    # Primeiro tenta os caches locais (memória e SQLite): se este EAN foi buscado recentemente,
+    # o produto e seus lotes vêm de lá e o SQL Server nem é consultado.
+    payload = get_cached_product(barcode)
 
-    sql_cursor = sql_conn.cursor()
-    try:
-        # Query SQL para buscar TODOS os lotes de um produto pelo EAN.
-        # A condição 'and lt.Qtd_Saldo > 0' foi REMOVIDA para permitir
-        # a busca de produtos com saldo zero, conforme solicitado.
-        # O multiplicador é inferido usando um CASE na p.Unidade_Venda.
-        # Comentários de linha Python (#) foram removidos da string SQL para evitar erros de sintaxe no SQL Server.
-        query = """
-            SELECT 
-                lt.Cod_Produt, 
-                Cod_Lote = ISNULL(lt.Cod_Lote, '*'), 
-                lt.Dat_Fabric,
-                lt.Dat_Vencim, 
-                QtdSld = SUM(lt.Qtd_Saldo),         
-                p.Descricao, 
-                f.Fantasia, 
-                dp.Cod_LocFis, 
-                p.Unidade_Venda, 
-                p.Cod_EAN,
-                CASE 
-                    WHEN p.Unidade_Venda = 'CX' THEN 30 -- Exemplo: 1 caixa = 30 unidades
-                    WHEN p.Unidade_Venda = 'FD' THEN 10 -- Exemplo: 1 fardo = 10 unidades
-                    ELSE 1 -- Padrão: 1 unidade
-                END AS MultiplicadorUnidade,
-                dbo.FN_EAN13Ok(p.Cod_EAN) 
-            FROM PRXES pr      
-            LEFT JOIN DPXPR dp ON (dp.Cod_Estabe = pr.Cod_Estabe AND dp.Cod_Produt = pr.Cod_Produt)       
-            LEFT JOIN PRLOT lt ON (pr.Cod_Estabe = lt.Cod_Estabe AND pr.Cod_Produt = lt.Cod_Produt)       
-            LEFT JOIN PRODU p ON (pr.Cod_Produt = p.Codigo)         
-            LEFT JOIN FABRI f ON (p.Cod_Fabricante = f.Codigo)      
-            WHERE lt.Cod_Estabe = 0
-              AND p.Tipo = '00'
-              AND p.Cod_EAN = ?
-            GROUP BY 
-                lt.Cod_Produt, 
-                lt.Cod_Lote, 
-                lt.Dat_Fabric,
-                lt.Dat_Vencim, 
-                p.Descricao, 
-                f.Fantasia, 
-                dp.Cod_LocFis, 
-                p.Unidade_Venda, 
-                p.Cod_EAN,
-                CASE 
-                    WHEN p.Unidade_Venda = 'CX' THEN 30
-                    WHEN p.Unidade_Venda = 'FD' THEN 10
-                    ELSE 1
-                END
-            ORDER BY Cod_EAN, lt.Cod_Lote, lt.Dat_Fabric, lt.Dat_Vencim
-        """
-        sql_cursor.execute(query, barcode)
-        products_found = sql_cursor.fetchall() # Obtém TODOS os resultados (todos os lotes)
-
-        if not products_found:
-            # Se nenhum produto for encontrado no SQL Server, retorna falha.
-            return jsonify({'success': False, 'message': 'Produto não encontrado com este código de barras ou critérios.'})
-
-        # Extrai informações comuns do produto (assumindo que são as mesmas para todos os lotes)
-        first_product = products_found[0]
-        common_product_data = {
-            'codigo_produto': first_product.Cod_Produt,
-            'codigo_barras': first_product.Cod_EAN,
-            'nome_produto': first_product.Descricao,
-            'multiplicador_sugerido': first_product.MultiplicadorUnidade,
-            'unidade_venda': first_product.Unidade_Venda
-        }
+    if payload is None:
+        try:
+            with sqlserver_conn() as sql_conn:
+                if not sql_conn:
+                    # Se não conseguir conectar ao SQL Server, retorna erro.
+                    return jsonify({'success': False, 'message': 'Não foi possível conectar ao banco de dados SQL Server. Verifique as configurações.'}), 500
+
+                sql_cursor = get_sqlserver_cursor(sql_conn, 'search')
+                sql_cursor.setinputsizes(SEARCH_BARCODE_INPUT_SIZES)
+                sql_cursor.execute(SEARCH_PRODUCT_QUERY, barcode)
+
+                # Lê os lotes em blocos de SQLSERVER_FETCH_ROWS (arraysize do cursor), até esgotar o resultado.
+                while True:
+                    products_found = sql_cursor.fetchmany()
+                    if not products_found:
+                        break
+                    if payload is None:
+                        # Extrai informações comuns do produto (assumindo que são as mesmas para todos os lotes)
+                        payload = {'product': product_from_row(products_found[0]), 'lotes': []}
+                    payload['lotes'].extend(map(lote_from_row, products_found))
+
+                if payload is None:
+                    # Se nenhum produto for encontrado no SQL Server, retorna falha.
+                    # (Resultados negativos não vão para o cache: o produto pode ser cadastrado a qualquer momento.)
+                    return jsonify({'success': False, 'message': 'Produto não encontrado com este código de barras ou critérios.'})
+        except pyodbc.Error as e:
+            # Captura erros específicos do pyodbc ao executar a query SQL Server
+            print(f"Erro SQL Server ao buscar produto: {e}")
+            return jsonify({'success': False, 'message': f'Erro SQL Server ao buscar produto: {str(e)}'}), 500
+        except Exception as e:
+            # Captura quaisquer outros erros inesperados
+            print(f"Erro inesperado ao buscar produto: {e}")
+            return jsonify({'success': False, 'message': f'Erro inesperado ao buscar produto: {str(e)}'}), 500
+
+        store_product_cache(barcode, payload)
+
+    # Retorna os dados comuns do produto, a lista de lotes e o último lote contado (se houver).
+    # O último lote contado ajuda a otimizar o fluxo de adição no frontend,
+    # permitindo o incremento automático se o mesmo lote for bipado novamente.
+    return jsonify({
+        'success': True, 
+        'product': payload['product'], 
+        'lotes': payload['lotes'],
+        'last_counted_lot': get_last_counted_lot(payload['product']['codigo_produto']) # Informação do último lote contado no SQLite
+    })
+
+def normalize_ean(codigo):
+    """
+    Forma canônica de um EAN para comparar os códigos pedidos com os devolvidos pelo SQL Server,
+    que ignora espaços à direita e (na collation padrão) maiúsculas/minúsculas ao filtrar Cod_EAN.
+    """
+    return codigo.strip().upper()
+
+@app.route('/search_products_batch', methods=['POST'])
+def search_products_batch():
+    """
+    Rota para buscar vários produtos de uma vez (ex.: leituras feitas sem conexão e enviadas juntas).
+    Recebe {'barcodes': [...]} e devolve {'success': True, 'results': {código: resultado}}, onde cada
+    resultado tem o mesmo formato da resposta de /search_product. Os códigos que não estão em cache
+    são buscados no SQL Server em uma única consulta (Cod_EAN IN (...)), em vez de uma ida por código.
+    """
+    data = request.get_json(silent=True)
+    barcodes = data.get('barcodes') if isinstance(data, dict) else None
+    if not barcodes or not isinstance(barcodes, list) or not all(isinstance(b, str) and b for b in barcodes):
+        return jsonify({'success': False, 'message': 'Envie a lista de códigos de barras a buscar.'}), 400
+    barcodes = list(dict.fromkeys(barcodes)) # Remove repetidos, mantendo a ordem
+    if len(barcodes) > SEARCH_BATCH_MAX:
+        return jsonify({'success': False, 'message': f'Envie no máximo {SEARCH_BATCH_MAX} códigos por vez.'}), 400
+
+    payloads = {} # {código pedido: payload}
+    misses = []
+    for barcode in barcodes:
+        payload = get_cached_product(barcode)
+        if payload is None:
+            misses.append(barcode)
+        else:
+            payloads[barcode] = payload
 
-        # Lista para armazenar os detalhes de cada lote encontrado no SQL Server
-        lotes_data = []
-        for product in products_found:
-            # Formata as datas para YYYY-MM-DD ou string vazia se NULL
-            data_fabricacao_str = product.Dat_Fabric.strftime('%Y-%m-%d') if product.Dat_Fabric else ''
-            data_validade_str = product.Dat_Vencim.strftime('%Y-%m-%d') if product.Dat_Vencim else ''
-            lotes_data.append({
-                'lote': product.Cod_Lote,
-                'data_fabricacao': data_fabricacao_str,
-                'data_validade': data_validade_str,
-                'saldo_disponivel': product.QtdSld # Saldo disponível para este lote
-            })
-
-        # --- NOVO: Verificar o último lote contado para este produto no SQLite ---
-        # Esta consulta ajuda a otimizar o fluxo de adição no frontend,
-        # permitindo o incremento automático se o mesmo lote for bipado novamente.
-        last_counted_lot_info = None
-        sqlite_conn = None
+    if misses:
         try:
-            sqlite_conn = sqlite3.connect(COLLECTION_DB_PATH)
-            sqlite_cursor = sqlite_conn.cursor()
-            sqlite_cursor.execute("""
-                SELECT Id, Lote, DataFabricacao, DataValidade, MultiplicadorUsado
-                FROM ColetaEstoque
-                WHERE CodigoProduto = ?
-                ORDER BY DataHoraColeta DESC
-                LIMIT 1
-            """, (common_product_data['codigo_produto'],))
-            last_lot_row = sqlite_cursor.fetchone()
-            if last_lot_row:
-                last_counted_lot_info = {
-                    'id': last_lot_row[0], # ID do item na coleta (SQLite)
-                    'lote': last_lot_row[1],
-                    'data_fabricacao': last_lot_row[2],
-                    'data_validade': last_lot_row[3],
-                    'multiplicador_usado': last_lot_row[4]
-                }
-        except sqlite3.Error as e:
-            print(f"Erro ao buscar último lote contado no SQLite: {e}")
-            # Não impede a busca principal, apenas loga o erro no console do servidor.
-        finally:
-            if sqlite_conn:
-                sqlite_conn.close()
-
-        # Retorna os dados comuns do produto, a lista de lotes e o último lote contado (se houver)
-        return jsonify({
-            'success': True, 
-            'product': common_product_data, 
-            'lotes': lotes_data,
-            'last_counted_lot': last_counted_lot_info # Informação do último lote contado no SQLite
-        })
-    except pyodbc.Error as e:
-        # Captura erros específicos do pyodbc ao executar a query SQL Server
-        print(f"Erro SQL Server ao buscar produto: {e}")
-        return jsonify({'success': False, 'message': f'Erro SQL Server ao buscar produto: {str(e)}'}), 500
-    except Exception as e:
-        # Captura quaisquer outros erros inesperados
-        print(f"Erro inesperado ao buscar produto: {e}")
-        return jsonify({'success': False, 'message': f'Erro inesperado ao buscar produto: {str(e)}'}), 500
-    finally:
-        if sql_conn:
-            sql_conn.close()
+            with sqlserver_conn() as sql_conn:
+                if not sql_conn:
+                    return jsonify({'success': False, 'message': 'Não foi possível conectar ao banco de dados SQL Server. Verifique as configurações.'}), 500
+                # Um parâmetro por EAN normalizado distinto (códigos que diferem só por espaços/caixa viram um só).
+                eans = list(dict.fromkeys(map(normalize_ean, misses)))
+                query = SEARCH_PRODUCTS_BATCH_QUERY.format(marcadores=','.join('?' * len(eans)))
+                sql_cursor = get_sqlserver_cursor(sql_conn, 'search_batch')
+                sql_cursor.execute(query, *eans)
+                new_payloads = {} # {EAN normalizado: payload}
+                while True:
+                    rows = sql_cursor.fetchmany()
+                    if not rows:
+                        break
+                    for row in rows:
+                        # Agrupa os lotes pelo EAN de cada linha, normalizado como os códigos pedidos
+                        ean = normalize_ean(row.Cod_EAN or '')
+                        payload = new_payloads.get(ean)
+                        if payload is None:
+                            payload = new_payloads[ean] = {'product': product_from_row(row), 'lotes': []}
+                        payload['lotes'].append(lote_from_row(row))
+        except pyodbc.Error as e:
+            print(f"Erro SQL Server ao buscar produtos em lote: {e}")
+            return jsonify({'success': False, 'message': f'Erro SQL Server ao buscar produtos: {str(e)}'}), 500
+        except Exception as e:
+            print(f"Erro inesperado ao buscar produtos em lote: {e}")
+            return jsonify({'success': False, 'message': f'Erro inesperado ao buscar produtos: {str(e)}'}), 500
+
+        # Associa cada código pedido ao produto do seu EAN normalizado e o guarda no cache pelo
+        # código como foi pedido, igual a /search_product.
+        for barcode in misses:
+            payload = new_payloads.get(normalize_ean(barcode))
+            if payload is not None:
+                store_product_cache(barcode, payload)
+                payloads[barcode] = payload
+
+    results = {}
+    for barcode in barcodes:
+        payload = payloads.get(barcode)
+        if payload is None:
+            results[barcode] = {'success': False, 'message': 'Produto não encontrado com este código de barras ou critérios.'}
+        else:
+            results[barcode] = {
+                'success': True,
+                'product': payload['product'],
+                'lotes': payload['lotes'],
+                'last_counted_lot': get_last_counted_lot(payload['product']['codigo_produto'])
+            }
+    return jsonify({'success': True, 'results': results})
+
+@app.route('/invalidate_product_cache', methods=['POST'])
+def invalidate_product_cache():
+    """
+    Rota administrativa para descartar o cache local de produtos.
+    Aceita opcionalmente 'barcode' (JSON ou formulário) para invalidar apenas um produto;
+    sem ele, todo o cache é descartado e as próximas buscas voltam ao SQL Server.
+    """
+    data = request.get_json(silent=True) or request.form
+    barcode = data.get('barcode')
+    try:
+        removed = clear_product_cache(barcode)
+        return jsonify({'success': True, 'message': f'{removed} produto(s) removido(s) do cache.'})
+    except sqlite3.Error as e:
+        print(f"Erro ao limpar o cache de produtos: {e}")
+        return jsonify({'success': False, 'message': f'Erro ao limpar o cache de produtos: {str(e)}'}), 500
 
 @app.route('/add_to_selected_lot', methods=['POST'])
 def add_to_selected_lot():
@@ -388,131 +1360,69 @@ def add_to_selected_lot():
     if not data:
         return jsonify({'success': False, 'message': 'Dados inválidos.'}), 400
 
-    # Coleta os dados do produto e lote selecionado enviados pelo frontend
-    codigo_produto = data.get('codigo_produto')
-    codigo_barras = data.get('codigo_barras')
-    nome_produto = data.get('nome_produto')
-    lote_selecionado = data.get('lote')
-    data_fabricacao_selecionada = data.get('data_fabricacao')
-    data_validade_selecionada = data.get('data_validade')
-
-    # Tenta converter quantidade_base e multiplicador para int.
+    # Valida e extrai os dados do produto e lote selecionado enviados pelo frontend
     try:
-        quantidade_a_adicionar_base = int(data.get('quantidade_base', 0)) # Quantidade base que o usuário quer adicionar
-        multiplicador_sugerido = int(data.get('multiplicador_sugerido', 1))
-    except ValueError:
-        return jsonify({'success': False, 'message': 'Quantidade base ou multiplicador inválido.'}), 400
-
-    # Valida se todos os campos obrigatórios estão presentes
-    if not all([codigo_produto, codigo_barras, nome_produto, lote_selecionado, 
-                data_fabricacao_selecionada, data_validade_selecionada]):
-        return jsonify({'success': False, 'message': 'Todos os campos do produto e lote são obrigatórios.'}), 400
-
-    # Valida se a quantidade a adicionar é positiva
-    if quantidade_a_adicionar_base <= 0:
-        return jsonify({'success': False, 'message': 'A quantidade a adicionar deve ser maior que zero.'}), 400
+        fields, quantidade_a_adicionar_base, multiplicador_sugerido = parse_coleta_item(data)
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    (codigo_produto, codigo_barras, nome_produto, lote_selecionado,
+     data_fabricacao_selecionada, data_validade_selecionada) = fields
 
     # --- Validação de Saldo Disponível no SQL Server ---
-    # Conecta ao SQL Server para obter o saldo atual do lote.
-    sql_conn = get_sqlserver_connection()
-    if not sql_conn:
-        return jsonify({'success': False, 'message': 'Não foi possível conectar ao banco de dados SQL Server para validar saldo.'}), 500
-
-    sql_cursor = sql_conn.cursor()
-    saldo_disponivel = 0
+    # Conecta ao SQL Server para verificar se o saldo atual do lote comporta a quantidade.
     try:
-        # Consulta o saldo atual do lote específico no SQL Server.
-        # Usa ISNULL(CONVERT(VARCHAR(10), ..., 120), '') para lidar com datas NULL/vazias
-        # de forma segura, evitando erros de conversão de tipo.
-        saldo_query = """
-            SELECT SUM(lt.Qtd_Saldo) AS Saldo
-            FROM PRLOT lt
-            JOIN PRODU p ON lt.Cod_Produt = p.Codigo
-            WHERE lt.Cod_Estabe = 0
-              AND p.Cod_EAN = ?
-              AND ISNULL(lt.Cod_Lote, '*') = ?
-              AND ISNULL(CONVERT(VARCHAR(10), lt.Dat_Fabric, 120), '') = ?
-              AND ISNULL(CONVERT(VARCHAR(10), lt.Dat_Vencim, 120), '') = ?
-            GROUP BY lt.Cod_Produt, lt.Cod_Lote, lt.Dat_Fabric, lt.Dat_Vencim
-        """
-        sql_cursor.execute(saldo_query, 
-                           codigo_barras, 
-                           lote_selecionado, 
-                           data_fabricacao_selecionada, 
-                           data_validade_selecionada)
-        saldo_result = sql_cursor.fetchone()
-        if saldo_result:
-            saldo_disponivel = saldo_result.Saldo
+        with sqlserver_conn() as sql_conn:
+            if not sql_conn:
+                return jsonify({'success': False, 'message': 'Não foi possível conectar ao banco de dados SQL Server para validar saldo.'}), 500
+            saldo_ok, saldo_disponivel = validate_lot_saldo(get_sqlserver_cursor(sql_conn, 'saldo'),
+                                                            codigo_barras,
+                                                            lote_selecionado,
+                                                            data_fabricacao_selecionada,
+                                                            data_validade_selecionada,
+                                                            quantidade_a_adicionar_base)
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400 # Data do lote inválida
     except pyodbc.Error as e:
         print(f"Erro SQL Server ao validar saldo: {e}")
         return jsonify({'success': False, 'message': f'Erro SQL Server ao validar saldo: {str(e)}'}), 500
     except Exception as e:
         print(f"Erro inesperado ao validar saldo no SQL Server: {e}")
         return jsonify({'success': False, 'message': f'Erro inesperado ao validar saldo do lote: {str(e)}'}), 500
-    finally:
-        if sql_conn:
-            sql_conn.close() # Garante que a conexão SQL Server seja fechada
 
     # Verifica se a quantidade a adicionar excede o saldo disponível.
-    if quantidade_a_adicionar_base > saldo_disponivel:
+    if not saldo_ok:
         return jsonify({'success': False, 'message': f'Quantidade a adicionar ({quantidade_a_adicionar_base}) excede o saldo disponível do lote ({saldo_disponivel}).'}), 400
 
     # --- Adição/Atualização na Coleta SQLite (se validação OK) ---
     # Conecta ao SQLite para registrar a coleta.
     sqlite_conn = None
     try:
-        sqlite_conn = sqlite3.connect(COLLECTION_DB_PATH)
+        sqlite_conn = get_coll_db()
         sqlite_cursor = sqlite_conn.cursor()
 
-        # Tenta encontrar um item existente na coleta SQLite com o mesmo produto e lote.
-        # A combinação de CodigoProduto, Lote, DataFabricacao e DataValidade define um item único.
-        sqlite_cursor.execute("""
-            SELECT Id, QuantidadeBase FROM ColetaEstoque
-            WHERE CodigoProduto = ? AND Lote = ? AND DataFabricacao = ? AND DataValidade = ?
-        """, (codigo_produto, lote_selecionado, data_fabricacao_selecionada, data_validade_selecionada))
-        existing_item = sqlite_cursor.fetchone()
-
-        message = ''
-        if existing_item:
-            # Se o item existe, incrementa a QuantidadeBase.
-            new_quantidade_base = existing_item[1] + quantidade_a_adicionar_base
-            sqlite_cursor.execute("""
-                UPDATE ColetaEstoque SET QuantidadeBase = ?, DataHoraColeta = CURRENT_TIMESTAMP
-                WHERE Id = ?
-            """, (new_quantidade_base, existing_item[0]))
-            sqlite_conn.commit()
-            message = f"Quantidade de {nome_produto} (Lote: {lote_selecionado}) atualizada para {new_quantidade_base * multiplicador_sugerido}."
-        else:
-            # Se o item não existe, insere um novo registro.
-            sqlite_cursor.execute("""
-                INSERT INTO ColetaEstoque (CodigoProduto, CodigoBarras, NomeProduto, Lote, DataFabricacao, DataValidade, QuantidadeBase, MultiplicadorUsado)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-            """, (codigo_produto, codigo_barras, nome_produto, lote_selecionado, data_fabricacao_selecionada, data_validade_selecionada, quantidade_a_adicionar_base, multiplicador_sugerido))
-            sqlite_conn.commit()
+        # UPSERT em um único comando: insere o item ou, se já existir um registro com a mesma
+        # chave (CodigoProduto, Lote, DataFabricacao, DataValidade), soma a quantidade a ele.
+        # Uma só instrução e uma só busca na árvore B, sem a janela de corrida entre SELECT e UPDATE.
+        sqlite_cursor.execute("BEGIN IMMEDIATE")
+        sqlite_cursor.execute(SQL_UPSERT_COLETA_RETURNING, (codigo_produto, codigo_barras, nome_produto, lote_selecionado, data_fabricacao_selecionada, data_validade_selecionada, quantidade_a_adicionar_base, multiplicador_sugerido))
+        row = sqlite_cursor.fetchone()
+        rev = bump_collection_rev(sqlite_cursor)
+        sqlite_cursor.execute("COMMIT")
+
+        # Se a quantidade resultante é igual à adicionada, o registro acabou de ser inserido.
+        new_quantidade_base = row[7]
+        if new_quantidade_base == quantidade_a_adicionar_base:
+            operation = 'insert'
             message = f"Produto {nome_produto} (Lote: {lote_selecionado}) adicionado à coleta."
+        else:
+            operation = 'update'
+            message = f"Quantidade de {nome_produto} (Lote: {lote_selecionado}) atualizada para {row[9]}."
 
-        # Após a modificação, busca a lista completa e atualizada de produtos coletados.
-        # Ordena por CodigoProduto, Lote, DataFabricacao e DataValidade para facilitar o agrupamento no frontend.
-        sqlite_cursor.execute("""
-            SELECT Id, CodigoProduto, CodigoBarras, NomeProduto, Lote, DataFabricacao, DataValidade, QuantidadeBase, MultiplicadorUsado
-            FROM ColetaEstoque ORDER BY CodigoProduto ASC, Lote ASC, DataFabricacao ASC, DataValidade ASC
-        """)
-        updated_products = []
-        for row in sqlite_cursor.fetchall():
-            updated_products.append({
-                'id': row[0],
-                'codigo_produto': row[1],
-                'codigo_barras': row[2],
-                'nome_produto': row[3],
-                'lote': row[4],
-                'data_fabricacao': row[5],
-                'data_validade': row[6],
-                'quantidade_base': row[7],
-                'multiplicador_usado': row[8],
-                'quantidade_total': row[7] * row[8] # Calcula a quantidade total para exibição
-            })
-
-        return jsonify({'success': True, 'counted_products': updated_products, 'message': message})
+        # Retorna apenas o item alterado (e a nova revisão) em vez da coleta inteira;
+        # o frontend aplica a mudança na sua cópia local da tabela.
+        counted_product = dict(zip(COLETA_ITEM_KEYS, row))
+
+        return jsonify({'success': True, 'counted_product': counted_product, 'operation': operation, 'rev': rev, 'message': message})
     except sqlite3.Error as e:
         print(f"Erro ao adicionar produto à coleta SQLite: {e}")
         if sqlite_conn:
@@ -521,9 +1431,72 @@ def add_to_selected_lot():
     except Exception as e:
         print(f"Erro inesperado ao adicionar produto à coleta: {e}")
         return jsonify({'success': False, 'message': f'Erro inesperado ao adicionar produto à coleta: {str(e)}'}), 500
-    finally:
+
+@app.route('/add_to_selected_lot_bulk', methods=['POST'])
+def add_to_selected_lot_bulk():
+    """
+    Rota para adicionar de uma só vez uma lista de leituras (lotes selecionados) à coleta (SQLite).
+    Recebe uma lista JSON de itens no mesmo formato de /add_to_selected_lot, valida o saldo
+    de cada lote no SQL Server e grava tudo em uma única transação (um único fsync por lote
+    de leituras, em vez de um por leitura). Se algum item for inválido, nada é gravado.
+    """
+    items = request.get_json(silent=True) # Corpo inválido vira None e recebe a resposta JSON de erro abaixo
+    if not items or not isinstance(items, list):
+        return jsonify({'success': False, 'message': 'Envie uma lista de itens a adicionar.'}), 400
+
+    # Valida cada item e acumula a quantidade total pedida por lote, já que o mesmo
+    # lote pode aparecer várias vezes na lista de leituras.
+    rows_to_upsert = []
+    quantidade_por_lote = {}
+    for item in items:
+        try:
+            fields, quantidade_base, multiplicador_sugerido = parse_coleta_item(item)
+        except ValueError as e:
+            return jsonify({'success': False, 'message': str(e)}), 400
+
+        rows_to_upsert.append(fields + (quantidade_base, multiplicador_sugerido))
+        # Chave do lote no SQL Server: CodigoBarras, Lote, DataFabricacao, DataValidade
+        lot_key = fields[1:2] + fields[3:6]
+        quantidade_por_lote[lot_key] = quantidade_por_lote.get(lot_key, 0) + quantidade_base
+
+    # --- Validação de Saldo Disponível no SQL Server (uma consulta por lote distinto) ---
+    try:
+        with sqlserver_conn() as sql_conn:
+            if not sql_conn:
+                return jsonify({'success': False, 'message': 'Não foi possível conectar ao banco de dados SQL Server para validar saldo.'}), 500
+            sql_cursor = get_sqlserver_cursor(sql_conn, 'saldo')
+            for lot_key, quantidade in quantidade_por_lote.items():
+                saldo_ok, saldo_disponivel = validate_lot_saldo(sql_cursor, *lot_key, quantidade)
+                if not saldo_ok:
+                    return jsonify({'success': False, 'message': f'Quantidade a adicionar ({quantidade}) excede o saldo disponível do lote {lot_key[1]} ({saldo_disponivel}).'}), 400
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400 # Data do lote inválida
+    except pyodbc.Error as e:
+        print(f"Erro SQL Server ao validar saldo em lote: {e}")
+        return jsonify({'success': False, 'message': f'Erro SQL Server ao validar saldo: {str(e)}'}), 500
+    except Exception as e:
+        print(f"Erro inesperado ao validar saldo em lote: {e}")
+        return jsonify({'success': False, 'message': f'Erro inesperado ao validar saldo dos lotes: {str(e)}'}), 500
+
+    # --- Gravação de todas as leituras em uma única transação ---
+    sqlite_conn = None
+    try:
+        sqlite_conn = get_coll_db()
+        sqlite_cursor = sqlite_conn.cursor()
+        sqlite_cursor.execute("BEGIN IMMEDIATE")
+        sqlite_cursor.executemany(SQL_UPSERT_COLETA, rows_to_upsert)
+        rev = bump_collection_rev(sqlite_cursor)
+        sqlite_cursor.execute("COMMIT")
+
+        return jsonify({'success': True, 'rev': rev, 'message': f'{len(rows_to_upsert)} leitura(s) adicionada(s) à coleta.'})
+    except sqlite3.Error as e:
+        print(f"Erro ao adicionar leituras em lote à coleta SQLite: {e}")
         if sqlite_conn:
-            sqlite_conn.close()
+            sqlite_conn.rollback() # Desfaz a transação inteira em caso de erro
+        return jsonify({'success': False, 'message': f'Erro interno ao adicionar leituras à coleta: {str(e)}'}), 500
+    except Exception as e:
+        print(f"Erro inesperado ao adicionar leituras em lote: {e}")
+        return jsonify({'success': False, 'message': f'Erro inesperado ao adicionar leituras à coleta: {str(e)}'}), 500
 
 @app.route('/add_to_last_counted_lot', methods=['POST'])
 def add_to_last_counted_lot():
@@ -531,13 +1504,16 @@ def add_to_last_counted_lot():
     Rota para incrementar a quantidade de um produto no último lote contado.
     Usado para o fluxo otimizado de contagem repetida do mesmo lote.
     """
-    data = request.get_json()
-    if not data:
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
         return jsonify({'success': False, 'message': 'Dados inválidos.'}), 400
 
     item_id = data.get('id') # ID do item na tabela ColetaEstoque
     # Quantidade a adicionar (padrão 1, mas pode ser especificada pelo frontend se necessário)
-    quantidade_a_adicionar_base = int(data.get('quantidade_base', 1)) 
+    try:
+        quantidade_a_adicionar_base = int(data.get('quantidade_base', 1))
+    except (TypeError, ValueError):
+        return jsonify({'success': False, 'message': 'Quantidade a adicionar inválida.'}), 400
 
     if not item_id:
         return jsonify({'success': False, 'message': 'ID do item de coleta não fornecido.'}), 400
@@ -546,105 +1522,74 @@ def add_to_last_counted_lot():
 
     sqlite_conn = None
     try:
-        sqlite_conn = sqlite3.connect(COLLECTION_DB_PATH)
+        sqlite_conn = get_coll_db()
         sqlite_cursor = sqlite_conn.cursor()
+        sqlite_cursor.row_factory = sqlite3.Row # Colunas acessadas pelo nome
 
         # Busca o item existente para obter seus detalhes e a quantidade atual
-        sqlite_cursor.execute("""
-            SELECT CodigoProduto, CodigoBarras, NomeProduto, QuantidadeBase, MultiplicadorUsado, Lote, DataFabricacao, DataValidade
-            FROM ColetaEstoque WHERE Id = ?
-        """, (item_id,))
-        existing_item = sqlite_cursor.fetchone()
+        sqlite_cursor.execute(SQL_SELECT_ITEM_PARA_INCREMENTO, (item_id,))
+        # fetchall() esgota o SELECT e encerra a transação de leitura implícita antes da ida ao
+        # SQL Server; a escrita abaixo fica sozinha em BEGIN IMMEDIATE ... COMMIT (um único fsync).
+        existing_item = next(iter(sqlite_cursor.fetchall()), None)
 
         if not existing_item:
             return jsonify({'success': False, 'message': 'Item de coleta não encontrado para atualização automática.'}), 404
 
-        codigo_produto = existing_item[0]
-        codigo_barras = existing_item[1] # Necessário para a validação de saldo
-        nome_produto = existing_item[2]
-        current_quantidade_base = existing_item[3]
-        multiplicador_usado = existing_item[4]
-        lote = existing_item[5]
-        data_fabricacao = existing_item[6]
-        data_validade = existing_item[7]
+        codigo_barras = existing_item['CodigoBarras'] # Necessário para a validação de saldo
+        nome_produto = existing_item['NomeProduto']
+        current_quantidade_base = existing_item['QuantidadeBase']
+        lote = existing_item['Lote']
+        data_fabricacao = existing_item['DataFabricacao']
+        data_validade = existing_item['DataValidade']
 
         new_quantidade_base = current_quantidade_base + quantidade_a_adicionar_base
 
         # --- Validação de Saldo Disponível no SQL Server para incremento automático ---
         # É crucial revalidar o saldo mesmo no incremento automático para evitar contagens acima do estoque real.
-        sql_conn = get_sqlserver_connection()
-        if not sql_conn:
-            return jsonify({'success': False, 'message': 'Não foi possível conectar ao banco de dados SQL Server para validar saldo.'}), 500
-
-        sql_cursor = sql_conn.cursor()
-        saldo_disponivel = 0
         try:
-            # Consulta o saldo atual do lote específico no SQL Server.
-            # Usa ISNULL(CONVERT(VARCHAR(10), ..., 120), '') para lidar com datas NULL/vazias
-            # de forma segura, evitando erros de conversão de tipo.
-            saldo_query = """
-                SELECT SUM(lt.Qtd_Saldo) AS Saldo
-                FROM PRLOT lt
-                JOIN PRODU p ON lt.Cod_Produt = p.Codigo
-                WHERE lt.Cod_Estabe = 0
-                  AND p.Cod_EAN = ? -- Usar CodigoBarras para buscar o lote específico
-                  AND ISNULL(lt.Cod_Lote, '*') = ?
-                  AND ISNULL(CONVERT(VARCHAR(10), lt.Dat_Fabric, 120), '') = ?
-                  AND ISNULL(CONVERT(VARCHAR(10), lt.Dat_Vencim, 120), '') = ?
-                GROUP BY lt.Cod_Produt, lt.Cod_Lote, lt.Dat_Fabric, lt.Dat_Vencim
-            """
-            sql_cursor.execute(saldo_query, 
-                               codigo_barras, # Passa o CodigoBarras do item existente
-                               lote, 
-                               data_fabricacao, 
-                               data_validade)
-            saldo_result = sql_cursor.fetchone()
-            if saldo_result:
-                saldo_disponivel = saldo_result.Saldo
+            with sqlserver_conn() as sql_conn:
+                if not sql_conn:
+                    return jsonify({'success': False, 'message': 'Não foi possível conectar ao banco de dados SQL Server para validar saldo.'}), 500
+                # Verifica se o saldo atual do lote comporta a nova quantidade total.
+                saldo_ok, saldo_disponivel = validate_lot_saldo(get_sqlserver_cursor(sql_conn, 'saldo'),
+                                                                codigo_barras, # Passa o CodigoBarras do item existente
+                                                                lote,
+                                                                data_fabricacao,
+                                                                data_validade,
+                                                                new_quantidade_base)
+        except ValueError as e:
+            # Data inválida gravada no item (ex.: editada antes de haver validação de datas)
+            return jsonify({'success': False, 'message': str(e)}), 400
         except pyodbc.Error as e:
             print(f"Erro SQL Server ao validar saldo para incremento automático: {e}")
             return jsonify({'success': False, 'message': f'Erro SQL Server ao validar saldo para incremento: {str(e)}'}), 500
         except Exception as e:
             print(f"Erro inesperado ao validar saldo para incremento automático: {e}")
             return jsonify({'success': False, 'message': f'Erro inesperado ao validar saldo para incremento: {str(e)}'}), 500
-        finally:
-            if sql_conn:
-                sql_conn.close()
 
         # Verifica se a nova quantidade base excede o saldo disponível.
-        if new_quantidade_base > saldo_disponivel:
+        if not saldo_ok:
             return jsonify({'success': False, 'message': f'Não foi possível incrementar. A nova quantidade ({new_quantidade_base}) excederia o saldo disponível do lote ({saldo_disponivel}).'}), 400
 
-        # Se a validação de saldo passar, atualiza a quantidade no SQLite.
-        sqlite_cursor.execute("""
-            UPDATE ColetaEstoque SET QuantidadeBase = ?, DataHoraColeta = CURRENT_TIMESTAMP
-            WHERE Id = ?
-        """, (new_quantidade_base, item_id))
-        sqlite_conn.commit()
-
-        message = f"Quantidade de {nome_produto} (Lote: {lote}) atualizada para {new_quantidade_base * multiplicador_usado}."
-
-        # Retorna a lista completa e atualizada de produtos coletados
-        sqlite_cursor.execute("""
-            SELECT Id, CodigoProduto, CodigoBarras, NomeProduto, Lote, DataFabricacao, DataValidade, QuantidadeBase, MultiplicadorUsado
-            FROM ColetaEstoque ORDER BY CodigoProduto ASC, Lote ASC, DataFabricacao ASC, DataValidade ASC
-        """)
-        updated_products = []
-        for row in sqlite_cursor.fetchall():
-            updated_products.append({
-                'id': row[0],
-                'codigo_produto': row[1],
-                'codigo_barras': row[2],
-                'nome_produto': row[3],
-                'lote': row[4],
-                'data_fabricacao': row[5],
-                'data_validade': row[6],
-                'quantidade_base': row[7],
-                'multiplicador_usado': row[8],
-                'quantidade_total': row[7] * row[8]
-            })
-
-        return jsonify({'success': True, 'counted_products': updated_products, 'message': message})
+        # Se a validação de saldo passar, incrementa a quantidade no SQLite em um único UPDATE ... RETURNING,
+        # condicionado ao saldo validado (ver SQL_INCREMENTA_COLETA_ITEM).
+        sqlite_cursor.execute("BEGIN IMMEDIATE")
+        sqlite_cursor.execute(SQL_INCREMENTA_COLETA_ITEM, (quantidade_a_adicionar_base, item_id, quantidade_a_adicionar_base,
+                                                          float(saldo_disponivel))) # Saldo pode vir como Decimal do SQL Server
+        row = sqlite_cursor.fetchone()
+        if not row:
+            # O item mudou entre a leitura e a gravação (outro incremento ou exclusão): nada foi alterado.
+            sqlite_cursor.execute("ROLLBACK")
+            return jsonify({'success': False, 'message': 'O item foi alterado ou removido por outra leitura enquanto o saldo era validado. Tente novamente.'}), 409
+        rev = bump_collection_rev(sqlite_cursor)
+        sqlite_cursor.execute("COMMIT")
+
+        # Retorna apenas o item alterado; o frontend aplica a mudança na sua cópia local da tabela.
+        counted_product = dict(zip(COLETA_ITEM_KEYS, row))
+
+        message = f"Quantidade de {nome_produto} (Lote: {lote}) atualizada para {counted_product['quantidade_total']}."
+
+        return jsonify({'success': True, 'counted_product': counted_product, 'operation': 'update', 'rev': rev, 'message': message})
     except sqlite3.Error as e:
         print(f"Erro ao atualizar quantidade no último lote contado: {e}")
         if sqlite_conn:
@@ -653,49 +1598,49 @@ def add_to_last_counted_lot():
     except Exception as e:
         print(f"Erro inesperado ao atualizar quantidade no último lote contado: {e}")
         return jsonify({'success': False, 'message': f'Erro inesperado ao atualizar quantidade: {str(e)}'}), 500
-    finally:
-        if sqlite_conn:
-            sqlite_conn.close()
+
+def etag_matches_request(etag):
+    """
+    Indica se o navegador já tem a versão 'etag' da resposta (cabeçalho If-None-Match).
+    O flask-compress troca o ETag das respostas compactadas por "<etag>:gzip" (ou ":br", ...),
+    e é esse valor que volta no If-None-Match; o sufixo é ignorado na comparação.
+    """
+    return any(tag.split(':', 1)[0] == etag for tag in request.if_none_match.as_set(include_weak=True))
 
 @app.route('/get_counted_products', methods=['GET'])
 def get_counted_products():
     """
     Rota para obter todos os produtos atualmente na lista de coleta do SQLite.
     Usado para carregar e atualizar a tabela no frontend.
+    Aceita 'limit' e 'offset' na query string para devolver apenas uma página da lista.
+    A resposta vem no formato compacto {"schema": [...], "rows": [[...]], "rev": N} (ver SQL_SELECT_COLETA_JSON).
     """
     conn = None
     try:
-        conn = sqlite3.connect(COLLECTION_DB_PATH)
-        cursor = conn.cursor()
-        # Seleciona todos os produtos contados, ordenados para facilitar o agrupamento visual no frontend.
-        cursor.execute("""
-            SELECT Id, CodigoProduto, CodigoBarras, NomeProduto, Lote, DataFabricacao, DataValidade, QuantidadeBase, MultiplicadorUsado
-            FROM ColetaEstoque ORDER BY CodigoProduto ASC, Lote ASC, DataFabricacao ASC, DataValidade ASC
-        """)
-        products = []
-        for row in cursor.fetchall():
-            products.append({
-                'id': row[0],
-                'codigo_produto': row[1],
-                'codigo_barras': row[2],
-                'nome_produto': row[3],
-                'lote': row[4],
-                'data_fabricacao': row[5],
-                'data_validade': row[6],
-                'quantidade_base': row[7],
-                'multiplicador_usado': row[8],
-                'quantidade_total': row[7] * row[8] # Calcula a quantidade total para exibição
-            })
-        return jsonify({'counted_products': products})
+        # Paginação opcional: ?limit=N&offset=M. Sem 'limit', todos os itens são devolvidos.
+        limit = request.args.get('limit', -1, type=int)
+        offset = request.args.get('offset', 0, type=int)
+        conn = get_coll_db()
+        # ETag = revisão da coleta (ColetaRevisao), incrementada a cada alteração. Se o navegador já
+        # tem a lista desta revisão (If-None-Match), responde 304 sem montar o JSON. A página
+        # (limit/offset) faz parte da URL, então cada página é guardada separadamente pelo navegador.
+        etag = f"coleta-{conn.execute(SQL_SELECT_REV).fetchone()[0]}"
+        if etag_matches_request(etag):
+            return Response(status=304, headers={'ETag': f'"{etag}"', 'Cache-Control': 'no-cache'})
+        # Os produtos contados, ordenados para facilitar o agrupamento visual no frontend,
+        # já serializados em JSON pelo SQLite (ver SQL_SELECT_COLETA_JSON).
+        body = conn.execute(SQL_SELECT_COLETA_JSON, (limit, offset)).fetchone()[0]
+        response = Response(body, mimetype='application/json')
+        response.set_etag(etag)
+        # no-cache: o navegador guarda a resposta, mas sempre confirma a revisão antes de reutilizá-la.
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
     except sqlite3.Error as e:
         print(f"Erro ao obter produtos da coleta SQLite: {e}")
-        return jsonify({'counted_products': []}), 500
+        return jsonify({'schema': COLETA_ITEM_KEYS, 'rows': []}), 500
     except Exception as e:
         print(f"Erro inesperado ao obter produtos da coleta: {e}")
-        return jsonify({'counted_products': []}), 500
-    finally:
-        if conn:
-            conn.close()
+        return jsonify({'schema': COLETA_ITEM_KEYS, 'rows': []}), 500
 
 @app.route('/update_counted_product', methods=['POST'])
 def update_counted_product():
@@ -704,49 +1649,33 @@ def update_counted_product():
     Permite editar QuantidadeBase, MultiplicadorUsado, Lote, DataFabricacao e DataValidade.
     Inclui validação de entradas.
     """
-    data = request.get_json()
-    if not data:
-        return jsonify({'success': False, 'message': 'Dados inválidos.'}), 400
-
-    # Coleta os dados editados do frontend.
-    item_id = data.get('id')
-    lote = data.get('lote')
-    data_fabricacao = data.get('data_fabricacao')
-    data_validade = data.get('data_validade')
-
-    # Tenta converter quantidade_base e multiplicador para int.
+    # Coleta e valida os dados editados do frontend (ver parse_coleta_edicao).
     try:
-        quantidade_base = int(data.get('quantidade_base', 0))
-        multiplicador_usado = int(data.get('multiplicador_usado', 1))
-    except ValueError:
-        return jsonify({'success': False, 'message': 'Quantidade base ou multiplicador inválido.'}), 400
-
-    # Valida se todos os campos obrigatórios estão presentes.
-    if not all([item_id, lote, data_fabricacao, data_validade]):
-        return jsonify({'success': False, 'message': 'Todos os campos são obrigatórios para atualização.'}), 400
-
-    # Valida se quantidade_base e multiplicador_usado são positivos.
-    if quantidade_base <= 0 or multiplicador_usado <= 0:
-        return jsonify({'success': False, 'message': 'Quantidade base e multiplicador devem ser números positivos.'}), 400
+        item_id, lote, data_fabricacao, data_validade, quantidade_base, multiplicador_usado = \
+            parse_coleta_edicao(request.get_json(silent=True))
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
 
     conn = None
     try:
-        conn = sqlite3.connect(COLLECTION_DB_PATH)
+        conn = get_coll_db()
         cursor = conn.cursor()
         # Atualiza o registro na tabela ColetaEstoque
-        cursor.execute("""
-            UPDATE ColetaEstoque SET 
-                QuantidadeBase = ?, 
-                MultiplicadorUsado = ?, 
-                Lote = ?, 
-                DataFabricacao = ?, 
-                DataValidade = ?, 
-                DataHoraColeta = CURRENT_TIMESTAMP
-            WHERE Id = ?
-        """, (quantidade_base, multiplicador_usado, lote, data_fabricacao, data_validade, item_id))
-        conn.commit()
-        flash('Produto contado atualizado com sucesso!', 'success')
-        return jsonify({'success': True, 'message': 'Produto atualizado.'})
+        cursor.execute("BEGIN IMMEDIATE")
+        cursor.execute(SQL_UPDATE_COLETA_ITEM, (quantidade_base, multiplicador_usado, lote, data_fabricacao, data_validade, item_id))
+        row = cursor.fetchone()
+        if row is None:
+            conn.rollback()
+            return jsonify({'success': False, 'message': 'Item não encontrado na coleta.'}), 404
+        rev = bump_collection_rev(cursor)
+        cursor.execute("COMMIT")
+        return jsonify({'success': True, 'counted_product': dict(zip(COLETA_ITEM_KEYS, row)), 'operation': 'update',
+                        'rev': rev, 'message': 'Produto atualizado.'})
+    except sqlite3.IntegrityError:
+        # O índice único ux_coleta_key impede dois itens com o mesmo produto, lote e datas.
+        if conn:
+            conn.rollback()
+        return jsonify({'success': False, 'message': 'Já existe um item na coleta com este produto, lote e datas.'}), 400
     except sqlite3.Error as e:
         print(f"Erro ao atualizar produto na coleta SQLite: {e}")
         if conn:
@@ -755,29 +1684,30 @@ def update_counted_product():
     except Exception as e:
         print(f"Erro inesperado ao atualizar produto: {e}")
         return jsonify({'success': False, 'message': f'Erro inesperado ao atualizar produto: {str(e)}'}), 500
-    finally:
-        if conn:
-            conn.close()
 
 @app.route('/delete_counted_product', methods=['POST'])
 def delete_counted_product():
     """
     Rota para remover um produto contado específico do banco de dados SQLite.
     """
-    data = request.get_json()
-    if not data or 'id' not in data:
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or 'id' not in data:
         return jsonify({'success': False, 'message': 'ID do produto não fornecido.'}), 400
 
     item_id = data['id']
 
     conn = None
     try:
-        conn = sqlite3.connect(COLLECTION_DB_PATH)
+        conn = get_coll_db()
         cursor = conn.cursor()
-        cursor.execute("DELETE FROM ColetaEstoque WHERE Id = ?", (item_id,))
-        conn.commit()
-        flash('Produto removido da contagem com sucesso!', 'info')
-        return jsonify({'success': True, 'message': 'Produto removido.'})
+        cursor.execute("BEGIN IMMEDIATE")
+        cursor.execute(SQL_DELETE_COLETA_ITEM, (item_id,))
+        row = cursor.fetchone()
+        rev = bump_collection_rev(cursor)
+        cursor.execute("COMMIT")
+        # Devolve o Id removido (ou None, se o item já não existia) para o frontend retirá-lo da sua cópia local.
+        return jsonify({'success': True, 'deleted_id': row[0] if row else None, 'operation': 'delete',
+                        'rev': rev, 'message': 'Produto removido.'})
     except sqlite3.Error as e:
         print(f"Erro ao remover produto da coleta SQLite: {e}")
         if conn:
@@ -786,9 +1716,44 @@ def delete_counted_product():
     except Exception as e:
         print(f"Erro inesperado ao remover produto: {e}")
         return jsonify({'success': False, 'message': f'Erro inesperado ao remover produto: {str(e)}'}), 500
-    finally:
+
+@app.route('/delete_counted_products_bulk', methods=['POST'])
+def delete_counted_products_bulk():
+    """
+    Rota para remover de uma só vez vários produtos contados do banco de dados SQLite.
+    Recebe {'ids': [...]} e remove todos em uma única transação (uma requisição e um fsync,
+    em vez de um por item). Devolve os Ids efetivamente removidos.
+    """
+    data = request.get_json(silent=True)
+    ids = data.get('ids') if isinstance(data, dict) else None
+    if not ids or not isinstance(ids, list):
+        return jsonify({'success': False, 'message': 'Envie a lista de IDs a remover.'}), 400
+    # Aceita apenas inteiros ou strings só com dígitos: int() também converteria true (Id 1) e 1.9 (Id 1).
+    if not all((isinstance(item_id, int) and not isinstance(item_id, bool))
+               or (isinstance(item_id, str) and item_id.isascii() and item_id.isdigit())
+               for item_id in ids):
+        return jsonify({'success': False, 'message': 'Lista de IDs inválida.'}), 400
+    ids = [int(item_id) for item_id in ids]
+
+    conn = None
+    try:
+        conn = get_coll_db()
+        cursor = conn.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        cursor.execute(SQL_DELETE_COLETA_ITENS, (json.dumps(ids),))
+        deleted_ids = [row[0] for row in cursor.fetchall()]
+        rev = bump_collection_rev(cursor)
+        cursor.execute("COMMIT")
+        return jsonify({'success': True, 'deleted_ids': deleted_ids, 'operation': 'delete',
+                        'rev': rev, 'message': f'{len(deleted_ids)} produto(s) removido(s).'})
+    except sqlite3.Error as e:
+        print(f"Erro ao remover produtos em lote da coleta SQLite: {e}")
         if conn:
-            conn.close()
+            conn.rollback()
+        return jsonify({'success': False, 'message': f'Erro interno ao remover produtos: {str(e)}'}), 500
+    except Exception as e:
+        print(f"Erro inesperado ao remover produtos em lote: {e}")
+        return jsonify({'success': False, 'message': f'Erro inesperado ao remover produtos: {str(e)}'}), 500
 
 @app.route('/clear_counted_products', methods=['POST'])
 def clear_counted_products():
@@ -797,12 +1762,17 @@ def clear_counted_products():
     """
     conn = None
     try:
-        conn = sqlite3.connect(COLLECTION_DB_PATH)
+        conn = get_coll_db()
         cursor = conn.cursor()
-        cursor.execute("DELETE FROM ColetaEstoque")
-        conn.commit()
-        flash('Lista de produtos contados limpa com sucesso!', 'info')
-        return jsonify({'success': True, 'message': 'Contagem zerada.'})
+        cursor.execute("BEGIN IMMEDIATE")
+        cursor.execute(SQL_CLEAR_COLETA)
+        rev = bump_collection_rev(cursor)
+        cursor.execute("COMMIT")
+        # Devolve ao disco as páginas que ficaram livres (auto_vacuum=INCREMENTAL). O PRAGMA libera uma
+        # página por passo e o execute() do sqlite3 dá um único passo em comandos sem colunas de resultado;
+        # o executescript() executa até o fim.
+        conn.executescript("PRAGMA incremental_vacuum")
+        return jsonify({'success': True, 'rev': rev, 'message': 'Contagem zerada.'})
     except sqlite3.Error as e:
         print(f"Erro ao limpar produtos da coleta SQLite: {e}")
         if conn:
@@ -811,105 +1781,98 @@ def clear_counted_products():
     except Exception as e:
         print(f"Erro inesperado ao limpar produtos: {e}")
         return jsonify({'success': False, 'message': f'Erro inesperado ao limpar produtos: {str(e)}'}), 500
-    finally:
-        if conn:
-            conn.close()
 
 @app.route('/generate_import_file', methods=['GET'])
 def generate_import_file():
     """
     Rota para gerar o arquivo de importação de texto fixo com os produtos coletados.
     Formata os dados conforme o padrão exigido, incluindo espaçamento e datas.
+    O arquivo é enviado em partes (streaming) à medida que as linhas são lidas do SQLite,
+    sem montar o conteúdo inteiro em memória antes do download.
     """
+    # Usa uma conexão própria (e não a de get_coll_db), pois o cursor precisa continuar
+    # aberto enquanto a resposta é transmitida, depois que o contexto da requisição termina.
     conn = None
     try:
-        conn = sqlite3.connect(COLLECTION_DB_PATH)
-        cursor = conn.cursor()
-        # Seleciona os dados necessários para o arquivo de importação
-        cursor.execute("""
-            SELECT CodigoProduto, QuantidadeBase, MultiplicadorUsado, Lote, DataValidade, DataFabricacao
-            FROM ColetaEstoque ORDER BY DataHoraColeta ASC
-        """)
-        counted_products_from_db = cursor.fetchall()
+        conn = open_collection_conn()
+        cursor = conn.execute(SQL_SELECT_EXPORTACAO) # Linhas já formatadas pelo SQLite
+        first_rows = cursor.fetchmany(EXPORT_CHUNK_ROWS)
 
-        if not counted_products_from_db:
+        if not first_rows:
+            conn.close()
             flash('Nenhum produto contado para gerar o arquivo.', 'warning')
             return redirect(url_for('index'))
-
-        output_text_buffer = StringIO() # Buffer em memória para construir o arquivo
-
-        for item_db in counted_products_from_db:
-            # Desempacota os dados do item do banco de dados
-            codigo_produto = item_db[0]
-            quantidade_base = item_db[1]
-            multiplicador_usado = item_db[2]
-            lote = item_db[3]
-            data_validade_str = item_db[4]
-            data_fabricacao_str = item_db[5]
-
-            quantidade_total = quantidade_base * multiplicador_usado # Calcula a quantidade total
-
-            # Formata DataValidade para DD/MM/YYYY, preenchendo com espaços se inválida/nula
-            data_validade_formatada = '          ' # 10 espaços
-            if data_validade_str:
-                try:
-                    data_validade_dt = datetime.strptime(data_validade_str, '%Y-%m-%d')
-                    data_validade_formatada = data_validade_dt.strftime('%d/%m/%Y')
-                except ValueError:
-                    pass # Mantém '          ' se a data for inválida
-
-            # Formata DataFabricacao para DD/MM/YYYY, preenchendo com espaços se inválida/nula
-            data_fabricacao_formatada = '          ' # 10 espaços
-            if data_fabricacao_str:
-                try:
-                    data_fabricacao_dt = datetime.strptime(data_fabricacao_str, '%Y-%m-%d')
-                    data_fabricacao_formatada = data_fabricacao_dt.strftime('%d/%m/%Y')
-                except ValueError:
-                    pass # Mantém '          ' se a data for inválida
-
-            # Formata os campos com justificação à esquerda e truncagem para larguras fixas
-            codigo_produto_fmt = str(codigo_produto).ljust(14)[:14] # 14 caracteres
-            quantidade_produto_fmt = str(quantidade_total).ljust(6)[:6] # 6 caracteres
-            lote_produto_fmt = str(lote).ljust(19)[:19] # 19 caracteres
-
-            # Constrói a linha do arquivo com o formato de texto fixo, incluindo o espaço entre as datas
-            line = (
-                f"{codigo_produto_fmt}"
-                f"{quantidade_produto_fmt}"
-                f"{lote_produto_fmt}"
-                f"{data_validade_formatada} " # Espaço adicionado aqui para separar as datas
-                f"{data_fabricacao_formatada}"
-            )
-            output_text_buffer.write(line + '\n') # Escreve a linha no buffer, seguida de uma nova linha
-
-        csv_string = output_text_buffer.getvalue() # Obtém o conteúdo completo do buffer
-        # Codifica para 'latin-1' (ISO-8859-1) que é comum em sistemas legados no Brasil
-        output_bytes_buffer = BytesIO(csv_string.encode('latin-1'))
-        output_bytes_buffer.seek(0) # Volta para o início do buffer para leitura
-
-        # Envia o arquivo para download
-        return send_file(
-            output_bytes_buffer,
-            mimetype='text/plain', # Tipo MIME para arquivo de texto
-            as_attachment=True, # Força o download como anexo
-            download_name=f'COLETA_{datetime.now().strftime("%Y%m%d_%H%M%S")}.txt' # Nome do arquivo
-        )
     except sqlite3.Error as e:
+        if conn:
+            conn.close()
         print(f"Erro ao gerar arquivo de importação do SQLite: {e}")
         flash(f'Erro ao gerar arquivo de importação: {str(e)}', 'danger')
         return redirect(url_for('index'))
-    except Exception as e:
-        print(f"Erro inesperado ao gerar arquivo de importação: {e}")
-        flash(f'Erro inesperado ao gerar arquivo de importação: {str(e)}', 'danger')
-        return redirect(url_for('index'))
-    finally:
-        if conn:
+
+    def generate(rows):
+        """Gera o arquivo em blocos de linhas, fechando a conexão ao final da transmissão."""
+        try:
+            while rows:
+                # Uma linha por item, cada uma terminada por nova linha.
+                # Codifica para 'latin-1' (ISO-8859-1) que é comum em sistemas legados no Brasil;
+                # caracteres fora dessa tabela viram '?' (o download já começou e não pode mais falhar).
+                yield ''.join(row[0] + '\n' for row in rows).encode('latin-1', errors='replace')
+                rows = cursor.fetchmany(EXPORT_CHUNK_ROWS)
+        except sqlite3.Error as e:
+            print(f"Erro ao transmitir arquivo de importação do SQLite: {e}")
+        finally:
             conn.close()
 
+    def gzip_stream(chunks):
+        """Compacta em formato gzip, bloco a bloco, o que generate() produz."""
+        compressor = zlib.compressobj(EXPORT_GZIP_LEVEL, zlib.DEFLATED, 31) # wbits=31: cabeçalho gzip
+        for chunk in chunks:
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.flush()
+
+    # Envia o arquivo para download
+    download_name = f'COLETA_{datetime.now().strftime("%Y%m%d_%H%M%S")}.txt' # Nome do arquivo
+    headers = {'Content-Disposition': f'attachment; filename={download_name}', # Força o download como anexo
+               'Vary': 'Accept-Encoding'}
+    body = generate(first_rows)
+    if 'gzip' in request.accept_encodings:
+        # O navegador descompacta sozinho; o arquivo salvo continua sendo o texto original.
+        body = gzip_stream(body)
+        headers['Content-Encoding'] = 'gzip'
+    return Response(
+        body,
+        mimetype='text/plain', # Tipo MIME para arquivo de texto
+        headers=headers
+    )
+
 # Bloco principal para executar a aplicação Flask
 if __name__ == '__main__':
-    # app.run(debug=True, host='0.0.0.0')
-    # Para produção, use um servidor WSGI como Gunicorn ou Waitress.
-    # debug=True é útil para desenvolvimento, mas deve ser False em produção.
+    # Para produção, prefira um servidor WSGI com várias threads e conexões keep-alive, ex.:
+    #   gunicorn -k gthread --workers 1 --threads 8 --keep-alive 30 -b 0.0.0.0:5000 app:app
+    #   waitress-serve --threads=8 --listen=0.0.0.0:5000 app:app   (Windows)
+    # Um único worker basta: o SQLite aceita um escritor por vez e as threads compartilham os pools
+    # de conexões. Não use --preload com SQLSERVER_KEEPALIVE_INTERVAL > 0: a importação do módulo inicia
+    # a thread de keepalive e abre uma conexão com o SQL Server, e nenhuma das duas sobrevive ao fork
+    # do worker. Com um único worker o --preload não traz ganho; se usá-lo, deixe o intervalo em 0.
     # host='0.0.0.0' permite que a aplicação seja acessível de outras máquinas na rede.
-    app.run(debug=True, host='0.0.0.0', port=5000) # Porta 5000 é a padrão do Flask
+    if os.environ.get('FLASK_DEV'):
+        # Desenvolvimento (FLASK_DEV=1): servidor do Werkzeug com debugger e recarga automática.
+        # HTTP/1.1 mantém a conexão do coletor aberta entre uma bipagem e outra (o padrão HTTP/1.0
+        # do servidor de desenvolvimento abre uma conexão TCP nova a cada requisição).
+        from werkzeug.serving import WSGIRequestHandler
+        WSGIRequestHandler.protocol_version = "HTTP/1.1"
+        app.run(debug=True, host='0.0.0.0', port=5000) # Porta 5000 é a padrão do Flask
+    else:
+        try:
+            from waitress import serve # Servidor WSGI de produção (opcional, funciona também no Windows)
+        except ImportError:
+            serve = None
+        if serve is not None:
+            serve(app, host='0.0.0.0', port=5000, threads=8)
+        else:
+            # Sem o waitress, usa o servidor do Werkzeug sem debugger, uma thread por requisição.
+            from werkzeug.serving import WSGIRequestHandler
+            WSGIRequestHandler.protocol_version = "HTTP/1.1"
+            app.run(debug=False, threaded=True, host='0.0.0.0', port=5000)
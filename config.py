@@ -19,6 +19,11 @@ class Config:
     # Ele será salvo na mesma pasta onde o 'app.py' está localizado.
     DB_CONFIG_PATH = 'db_config.json'
 
+    # Intervalo (em segundos) entre as verificações das conexões ociosas com o SQL Server.
+    # Quando maior que zero, a aplicação abre uma conexão logo ao iniciar e a cada intervalo
+    # testa as conexões paradas no pool com "SELECT 1". 0 (padrão) desativa.
+    SQLSERVER_KEEPALIVE_INTERVAL = int(os.environ.get('SQLSERVER_KEEPALIVE_INTERVAL', '0'))
+
     # Outras configurações globais da aplicação podem ser adicionadas aqui.
     # Por exemplo:
     # UPLOAD_FOLDER = 'uploads/'
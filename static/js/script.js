@@ -57,6 +57,11 @@ document.addEventListener('DOMContentLoaded', function() {
     // Variável para armazenar os detalhes do produto atualmente exibido/selecionado
     let currentProductDetails = null;
 
+    // Cópia local da coleta exibida na tabela e a revisão do servidor a que ela corresponde.
+    // As rotas de adição retornam apenas o item alterado, que é aplicado sobre esta cópia.
+    let countedProducts = [];
+    let collectionRev = null;
+
     // --- Funções Auxiliares ---
 
     /**
@@ -262,7 +267,7 @@ document.addEventListener('DOMContentLoaded', function() {
                 selectLotModal.hide(); // Oculta o modal
                 productDetailsCard.style.display = 'none'; // Oculta o card de detalhes
                 currentProductDetails = null; // Limpa o produto atual
-                updateCountedProductsTable(data.counted_products); // Atualiza a tabela
+                applyCountedProductChange(data.counted_product, data.rev); // Atualiza só o item alterado na tabela
                 showMessage(data.message, 'success');
             } else {
                 showMessage(data.message, 'danger', selectLotMessage); // Exibe erro no modal
@@ -289,7 +294,7 @@ document.addEventListener('DOMContentLoaded', function() {
             const data = await response.json();
 
             if (data.success) {
-                updateCountedProductsTable(data.counted_products);
+                applyCountedProductChange(data.counted_product, data.rev); // Atualiza só o item alterado na tabela
                 showMessage(data.message, 'success');
             } else {
                 showMessage(data.message, 'danger');
@@ -300,6 +305,80 @@ document.addEventListener('DOMContentLoaded', function() {
         }
     }
 
+    /**
+     * Reconstrói os objetos dos produtos contados a partir do formato compacto de /get_counted_products,
+     * em que os nomes dos campos vêm uma única vez (schema) e cada item é um array de valores.
+     * @param {Array<string>} schema - Os nomes dos campos, na ordem dos valores de cada linha.
+     * @param {Array<Array>} rows - As linhas, uma por produto contado.
+     * @returns {Array<object>} A lista de produtos contados como objetos.
+     */
+    function expandCountedProducts(schema, rows) {
+        return rows.map(row => Object.fromEntries(schema.map((key, i) => [key, row[i]])));
+    }
+
+    /**
+     * Substitui a cópia local da coleta e redesenha a tabela.
+     * @param {Array<object>} products - A lista completa de produtos contados.
+     * @param {number|null} rev - A revisão da coleta no servidor correspondente à lista.
+     */
+    function setCountedProducts(products, rev) {
+        countedProducts = products;
+        collectionRev = rev;
+        updateCountedProductsTable(countedProducts);
+    }
+
+    /**
+     * Compara dois produtos contados na mesma ordem usada pelo servidor
+     * (CodigoProduto, Lote, DataFabricacao, DataValidade).
+     */
+    function compareCountedProducts(a, b) {
+        const keys = ['codigo_produto', 'lote', 'data_fabricacao', 'data_validade'];
+        for (const key of keys) {
+            if (a[key] < b[key]) return -1;
+            if (a[key] > b[key]) return 1;
+        }
+        return 0;
+    }
+
+    /**
+     * Aplica um único item inserido/alterado sobre a cópia local da coleta.
+     * Se a revisão recebida não for a seguinte à da cópia local (outro coletor alterou
+     * a coleta no meio tempo), recarrega a lista completa do servidor.
+     * @param {object} product - O item retornado pelo servidor.
+     * @param {number} rev - A nova revisão da coleta no servidor.
+     */
+    function applyCountedProductChange(product, rev) {
+        if (collectionRev === null || rev !== collectionRev + 1) {
+            loadCountedProducts();
+            return;
+        }
+        const index = countedProducts.findIndex(p => p.id === product.id);
+        if (index >= 0) {
+            countedProducts[index] = product;
+        } else {
+            countedProducts.push(product);
+        }
+        countedProducts.sort(compareCountedProducts); // A edição pode mudar lote/datas e, com isso, a posição
+        collectionRev = rev;
+        updateCountedProductsTable(countedProducts);
+    }
+
+    /**
+     * Remove um item da cópia local da coleta, com a mesma verificação de revisão
+     * de applyCountedProductChange.
+     * @param {number|null} productId - O ID do item removido no servidor.
+     * @param {number} rev - A nova revisão da coleta no servidor.
+     */
+    function applyCountedProductRemoval(productId, rev) {
+        if (collectionRev === null || rev !== collectionRev + 1) {
+            loadCountedProducts();
+            return;
+        }
+        countedProducts = countedProducts.filter(p => p.id !== productId);
+        collectionRev = rev;
+        updateCountedProductsTable(countedProducts);
+    }
+
     /**
      * Atualiza a tabela de produtos contados no frontend.
      * Agrupa os produtos pelo CodigoProduto e lista os lotes abaixo.
@@ -370,8 +449,8 @@ document.addEventListener('DOMContentLoaded', function() {
         try {
             const response = await fetch('/get_counted_products');
             const data = await response.json();
-            if (data.counted_products) {
-                updateCountedProductsTable(data.counted_products);
+            if (data.rows) {
+                setCountedProducts(expandCountedProducts(data.schema, data.rows), data.rev);
             }
         } catch (error) {
             console.error('Erro ao carregar produtos contados:', error);
@@ -431,7 +510,7 @@ document.addEventListener('DOMContentLoaded', function() {
 
             if (data.success) {
                 editProductModal.hide(); // Oculta o modal
-                loadCountedProducts(); // Recarrega a tabela para mostrar as alterações
+                applyCountedProductChange(data.counted_product, data.rev); // Atualiza só o item editado na tabela
                 showMessage(data.message, 'success');
             } else {
                 showMessage(data.message, 'danger');
@@ -459,7 +538,7 @@ document.addEventListener('DOMContentLoaded', function() {
                 const data = await response.json();
 
                 if (data.success) {
-                    loadCountedProducts(); // Recarrega a tabela
+                    applyCountedProductRemoval(data.deleted_id, data.rev); // Retira só o item removido da tabela
                     showMessage(data.message, 'info');
                 } else {
                     showMessage(data.message, 'danger');
@@ -565,7 +644,7 @@ document.addEventListener('DOMContentLoaded', function() {
                 });
                 const data = await response.json();
                 if (data.success) {
-                    updateCountedProductsTable([]); // Limpa a tabela no frontend
+                    setCountedProducts([], data.rev); // Limpa a tabela no frontend
                     showMessage(data.message, 'info');
                     productDetailsCard.style.display = 'none'; // Oculta detalhes do produto
                     currentProductDetails = null; // Limpa o produto atual
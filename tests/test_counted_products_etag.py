@@ -0,0 +1,63 @@
+# tests/test_counted_products_etag.py
+# Testes do ETag/304 de /get_counted_products. Rode com: python -m unittest discover tests
+
+import importlib
+import os
+import sys
+import tempfile
+import unittest
+
+RAIZ_DO_PROJETO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+try:
+    import pyodbc # O app.py importa o pyodbc (e o driver ODBC do sistema) já no carregamento
+except ImportError:
+    pyodbc = None
+
+
+@unittest.skipIf(pyodbc is None, 'pyodbc (ou o driver ODBC) não está disponível neste ambiente')
+class CountedProductsETagTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        # O banco de coleta (coleta_estoque.db) é criado no diretório atual: usa uma pasta temporária.
+        cls.cwd_original = os.getcwd()
+        cls.pasta = tempfile.TemporaryDirectory()
+        os.chdir(cls.pasta.name)
+        sys.path.insert(0, RAIZ_DO_PROJETO)
+        cls.app_module = importlib.import_module('app')
+        cls.client = cls.app_module.app.test_client()
+
+    @classmethod
+    def tearDownClass(cls):
+        os.chdir(cls.cwd_original)
+        sys.path.remove(RAIZ_DO_PROJETO)
+        cls.pasta.cleanup()
+
+    def get_etag(self):
+        response = self.client.get('/get_counted_products')
+        self.assertEqual(response.status_code, 200)
+        etag, _ = response.get_etag()
+        self.assertTrue(etag)
+        return etag
+
+    def test_same_etag_returns_304(self):
+        etag = self.get_etag()
+        response = self.client.get('/get_counted_products', headers={'If-None-Match': f'"{etag}"'})
+        self.assertEqual(response.status_code, 304)
+
+    def test_compressed_etag_returns_304(self):
+        # O flask-compress devolve ao navegador o ETag com o sufixo do algoritmo ("<etag>:gzip").
+        etag = self.get_etag()
+        for valor in (f'"{etag}:gzip"', f'W/"{etag}:br"', f'"outro", "{etag}:gzip"'):
+            response = self.client.get('/get_counted_products', headers={'If-None-Match': valor})
+            self.assertEqual(response.status_code, 304, valor)
+
+    def test_other_revision_returns_body(self):
+        response = self.client.get('/get_counted_products', headers={'If-None-Match': '"coleta-999999:gzip"'})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('rows', response.get_json())
+
+
+if __name__ == '__main__':
+    unittest.main()